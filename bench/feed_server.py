@@ -0,0 +1,126 @@
+import argparse
+import gzip
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo
+from google.transit import gtfs_realtime_pb2
+
+# Local Realtime Feed
+
+MELBOURNE = ZoneInfo("Australia/Melbourne")
+
+def build_feed(db_file, generation=0):
+    '''
+    FeedMessage with a trip update for every trip in gtfs.db on today's service day,
+    delayed 0-4 minutes (changing with `generation`), every 50th trip canceled.
+    '''
+    today = datetime.now(MELBOURNE).replace(hour=0, minute=0, second=0, microsecond=0)
+    day_start = int(today.replace(hour=12).timestamp()) - 12 * 3600
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(time.time())
+
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    rows = conn.execute("SELECT trip_id, stop_id, arrival_time FROM stop_times ORDER BY trip_id, stop_sequence")
+    current = None
+    for trip_id, stop_id, arrival in rows:
+        if trip_id != current:
+            current = trip_id
+            entity = feed.entity.add()
+            entity.id = trip_id
+            entity.trip_update.trip.trip_id = trip_id
+            delay = (sum(map(ord, trip_id)) + generation) % 5 * 60
+            relationship = 3 if len(feed.entity) % 50 == 0 else 0
+        update = entity.trip_update.stop_time_update.add()
+        update.stop_id = stop_id
+        update.arrival.time = day_start + arrival + delay
+        update.departure.time = day_start + arrival + delay
+        update.schedule_relationship = relationship
+    conn.close()
+    return feed.SerializeToString()
+
+class FeedServer:
+    '''
+    Stand-in for the upstream trip-updates endpoint on 127.0.0.1, answering like it does:
+    gzip when asked, ETag / If-None-Match, a new feed every `change_every` seconds (0 = never).
+    '''
+
+    def __init__(self, db_file, port=0, change_every=0):
+        self.db_file = db_file
+        self.change_every = change_every
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self._generation = 0
+        self._payload = build_feed(db_file)
+        self._compressed = gzip.compress(self._payload)
+        self._built = time.monotonic()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    def _current(self):
+        with self._lock:
+            if self.change_every and time.monotonic() - self._built >= self.change_every:
+                self._generation += 1
+                self._payload = build_feed(self.db_file, self._generation)
+                self._compressed = gzip.compress(self._payload)
+                self._built = time.monotonic()
+            return self._generation, self._payload, self._compressed
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                generation, payload, compressed = server._current()
+                etag = f'"{generation}"'
+                server.requests += 1
+                if self.headers.get("If-None-Match") == etag:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                body = payload
+                self.send_response(200)
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = compressed
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server.bytes_sent += len(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        return {"requests": self.requests, "not_modified": self.not_modified, "bytes_sent": self.bytes_sent,
+                "feed_bytes": len(self._payload), "generation": self._generation}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a realtime feed generated from gtfs.db")
+    parser.add_argument("db_file", nargs="?", default="gtfs.db")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--change-every", type=float, default=30)
+    args = parser.parse_args()
+    server = FeedServer(args.db_file, args.port, args.change_every).start()
+    print(f"serving {server.url}")
+    while True:
+        time.sleep(3600)
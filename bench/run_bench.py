@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# Benchmark
+#
+# Offline end to end run: synthetic GTFS -> gtfs.db import -> local realtime feed ->
+# per-station board latency -> /api/trains under concurrent clients, saved as JSON.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+_cwd = os.getcwd()
+os.chdir(REPO_DIR)              # startup mounts frontend/ relative to the working directory at import
+import current_trips
+import db_pool
+import gtfs_query
+import metrics
+import startup
+os.chdir(_cwd)
+
+import httpx
+import uvicorn
+from feed_server import FeedServer
+from synthetic_gtfs import generate
+
+def max_rss_mb():
+    '''
+    Peak resident set size of this process so far (ru_maxrss is KB on Linux, bytes on macOS).
+    '''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def summarise(samples):
+    '''
+    count / mean / p50 / p95 / p99 / max of durations in seconds, reported in milliseconds.
+    '''
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+    summary = {"count": len(samples), "mean_ms": round(sum(samples) / len(samples) * 1000, 3)}
+    for q in metrics.QUANTILES:
+        summary[f"p{round(q * 100)}_ms"] = round(metrics.quantile(samples, q) * 1000, 3)
+    summary["max_ms"] = round(samples[-1] * 1000, 3)
+    return summary
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# ----------------------------
+# Phases
+# ----------------------------
+def bench_import(gtfs_dir):
+    start = time.perf_counter()
+    report = startup.build_db(startup.DB_FILE, gtfs_dir)
+    return {"seconds": round(time.perf_counter() - start, 3), "steps": report,
+            "db_mb": round(os.path.getsize(startup.DB_FILE) / (1 << 20), 1)}
+
+def bench_boards(conn):
+    '''
+    Departure boards of the running service days, built cold under tracemalloc.
+    '''
+    gtfs_query.reset_caches()
+    tracemalloc.start()
+    start = time.perf_counter()
+    ids = gtfs_query.station_ids(conn, int(time.time()))
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ids, {"seconds": round(seconds, 3), "stations": len(ids), "retained_mb": round(current / (1 << 20), 1),
+                 "peak_mb": round(peak / (1 << 20), 1)}
+
+def bench_stations(conn, names):
+    '''
+    get_station_data() of every station: built (response cache bypassed) and served from the cache.
+    '''
+    current_trips.get_feed_index()
+    uncached, cached = [], []
+    trains = delayed = 0
+    for name in names:
+        station_id = gtfs_query.resolve_station(conn, name)
+        start = time.perf_counter()
+        data = gtfs_query.build_station_data(conn, station_id)
+        uncached.append(time.perf_counter() - start)
+        trains += len(data["trains"])
+        delayed += sum(1 for train in data["trains"] if train["delay_minutes"])
+
+    for name in names:
+        gtfs_query.get_station_data(name, conn)
+    for name in names:
+        start = time.perf_counter()
+        gtfs_query.get_station_data(name, conn)
+        cached.append(time.perf_counter() - start)
+    return {"trains": trains, "delayed": delayed, "uncached": summarise(uncached), "cached": summarise(cached)}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+async def load_clients(base_url, names, clients, duration):
+    '''
+    `clients` connections requesting /api/trains back to back for `duration` seconds,
+    each going round the stations from a different starting point.
+    '''
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + duration
+
+    async def client(n, http):
+        i = n
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            resp = await http.get("/api/trains", params={"station": names[i % len(names)]})
+            latencies.append(time.perf_counter() - start)
+            statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+            i += clients
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(n, http) for n in range(clients)))
+        elapsed = time.perf_counter() - start
+    return {"clients": clients, "seconds": round(elapsed, 3), "requests": len(latencies),
+            "rps": round(len(latencies) / elapsed, 1), "status": {str(k): v for k, v in statuses.items()},
+            "latency": summarise(latencies)}
+
+def bench_http(names, clients, duration):
+    '''
+    startup.app under uvicorn in a background thread (poller included), loaded from this thread.
+    '''
+    startup.WARM_UP = False     # the phases before already loaded everything
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(startup.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("uvicorn did not start")
+        time.sleep(0.05)
+    try:
+        hits = dict(gtfs_query.RESPONSE_CACHE_STATS)
+        result = asyncio.run(load_clients(f"http://127.0.0.1:{port}", names, clients, duration))
+        result["response_cache"] = {k: v - hits[k] for k, v in gtfs_query.RESPONSE_CACHE_STATS.items()}
+        return result
+    finally:
+        server.should_exit = True
+        thread.join(10)
+
+# ----------------------------
+# Comparison
+# ----------------------------
+def flatten(data, prefix=""):
+    values = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+def compare(old, new):
+    '''
+    Print every numeric result present in both runs with its relative change.
+    '''
+    old_values, new_values = flatten(old["results"]), flatten(new["results"])
+    print(f"{'metric':<48} {'old':>12} {'new':>12} {'change':>8}")
+    for name, value in new_values.items():
+        if name not in old_values:
+            continue
+        before = old_values[name]
+        change = f"{(value - before) / before * 100:+.1f}%" if before else ""
+        print(f"{name:<48} {before:>12} {value:>12} {change:>8}")
+
+def run(args, workdir):
+    gtfs_dir = os.path.join(workdir, "gtfs")
+    os.chdir(workdir)           # gtfs.db, api_key.txt and realtime.snapshot are relative to it
+    results = {}
+
+    start = time.perf_counter()
+    rows = generate(gtfs_dir, args.lines, args.stations_per_line, args.trips_per_direction)
+    results["generate"] = {"seconds": round(time.perf_counter() - start, 3), "rows": rows}
+    print(f"[bench] generated {rows}")
+
+    results["import"] = bench_import(gtfs_dir)
+    results["memory_mb"] = {"after_import": max_rss_mb()}
+
+    feed = FeedServer(startup.DB_FILE, change_every=args.feed_change_every).start()
+    current_trips.URL = feed.url
+    try:
+        conn = db_pool.get_conn()
+        names = [name for stop_id, name in conn.execute(
+            "SELECT stop_id, stop_name FROM stops WHERE location_type = '1' ORDER BY stop_id")]
+        ids, results["boards"] = bench_boards(conn)
+        results["memory_mb"]["after_boards"] = max_rss_mb()
+        print(f"[bench] boards {results['boards']}")
+
+        results["stations"] = bench_stations(conn, names)
+        results["memory_mb"]["after_stations"] = max_rss_mb()
+        print(f"[bench] stations {results['stations']}")
+
+        results["http"] = bench_http(names, args.clients, args.duration)
+        results["memory_mb"]["after_http"] = max_rss_mb()
+        print(f"[bench] http {results['http']}")
+    finally:
+        feed.stop()
+    results["feed"] = {**feed.stats(), **current_trips.feed_stats()}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark on a synthetic network, results saved as JSON")
+    parser.add_argument("--lines", type=int, default=16)
+    parser.add_argument("--stations-per-line", type=int, default=14)
+    parser.add_argument("--trips-per-direction", type=int, default=120)
+    parser.add_argument("--clients", type=int, default=32, help="concurrent /api/trains clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of /api/trains load")
+    parser.add_argument("--feed-change-every", type=float, default=5, help="seconds between new realtime feeds")
+    parser.add_argument("--workdir", help="keep gtfs.db and the generated files here (default: temporary)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", metavar="OLD_JSON", help="print the change against an earlier result file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    old = os.path.abspath(args.compare) if args.compare else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="nexttrain-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run(args, workdir)
+    finally:
+        os.chdir(_cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    data = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "timetable_engine": gtfs_query.TIMETABLE_ENGINE,
+        "params": {k: v for k, v in vars(args).items() if k not in ("workdir", "output", "compare")},
+        "results": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    print(f"[bench] saved {output}")
+
+    if old:
+        with open(old, encoding="utf-8") as f:
+            compare(json.load(f), data)
@@ -0,0 +1,81 @@
+import argparse
+import csv
+import os
+import random
+
+# Synthetic GTFS
+
+# City Loop stations every line runs through before Flinders Street
+CITY = ["Southern Cross", "Flagstaff", "Melbourne Central", "Parliament", "Town Hall"]
+
+def generate(out, lines=16, stations_per_line=14, trips_per_direction=120, seed=1):
+    '''
+    Write a metro-like GTFS dataset into `out`: `lines` lines of stations_per_line suburban stations,
+    each running through three City Loop stations to Flinders Street, trips_per_direction trips a day
+    each way every 10 minutes from 04:00 (the last ones run past 24:00), inbound and outbound trips
+    of the same train share a block_id. Returns {file: rows written}.
+    '''
+    os.makedirs(out, exist_ok=True)
+    rnd = random.Random(seed)
+    stops, stop_times, trips, routes = [], [], [], []
+    parents = {}
+    platforms = {}
+
+    def parent(name):
+        if name not in parents:
+            parents[name] = f"P{len(parents) + 1}"
+            stops.append([parents[name], f"{name} Station", "-37.8", "144.9", "1", "", ""])
+        return parents[name]
+
+    def platform(name, code):
+        if (name, code) not in platforms:
+            stop_id = platforms[(name, code)] = f"{parent(name)}_{code}"
+            stops.append([stop_id, f"{name} Station", "-37.8", "144.9", "0", parent(name), str(code)])
+        return platforms[(name, code)]
+
+    for line in range(lines):
+        names = [f"Line{line} Stop{i}" for i in range(stations_per_line)]
+        names += CITY[line % 3: line % 3 + 3] + ["Flinders Street"]
+        routes.append([f"R{line}", "1", f"L{line}", f"Line {line}", "2", f"{rnd.randrange(1 << 24):06X}", "FFFFFF"])
+
+        for direction in (0, 1):
+            sequence = names if direction == 1 else names[::-1]
+            for t in range(trips_per_direction):
+                trip_id = f"T{line}_{direction}_{t}"
+                service = "WK" if t % 4 else "ALL"
+                trips.append([f"R{line}", service, trip_id, "", sequence[-1], str(direction), f"B{line}_{t}", "1"])
+                start = 4 * 3600 + t * 600 + direction * 4200    # outbound leaves after the inbound run
+                for i, name in enumerate(sequence):
+                    secs = start + i * 150
+                    hhmmss = f"{secs // 3600:02d}:{secs % 3600 // 60:02d}:{secs % 60:02d}"
+                    stop_times.append([trip_id, hhmmss, hhmmss, platform(name, 1 + direction), str(i + 1),
+                                       "", "0", "0", ""])
+
+    files = {
+        "stops.txt": (["stop_id", "stop_name", "stop_lat", "stop_lon", "location_type", "parent_station",
+                       "platform_code"], stops),
+        "stop_times.txt": (["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence",
+                            "stop_headsign", "pickup_type", "drop_off_type", "shape_dist_traveled"], stop_times),
+        "trips.txt": (["route_id", "service_id", "trip_id", "shape_id", "trip_headsign", "direction_id",
+                       "block_id", "wheelchair_accessible"], trips),
+        "routes.txt": (["route_id", "agency_id", "route_short_name", "route_long_name", "route_type",
+                        "route_color", "route_text_color"], routes),
+        "calendar.txt": (["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday",
+                          "sunday", "start_date", "end_date"],
+                         [[service] + ["1"] * 7 + ["20000101", "20991231"] for service in ("WK", "ALL")]),
+    }
+    for filename, (header, rows) in files.items():
+        with open(os.path.join(out, filename), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+    return {filename: len(rows) for filename, (header, rows) in files.items()}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic metro GTFS dataset")
+    parser.add_argument("out")
+    parser.add_argument("--lines", type=int, default=16)
+    parser.add_argument("--stations-per-line", type=int, default=14)
+    parser.add_argument("--trips-per-direction", type=int, default=120)
+    args = parser.parse_args()
+    print(generate(args.out, args.lines, args.stations_per_line, args.trips_per_direction))
@@ -1,35 +1,72 @@
 import requests
-import sqlite3
-from datetime import datetime, timedelta, timezone
+import httpx
+import asyncio
+import hashlib
+import db_pool
+import feed_snapshot
+import metrics
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from google.transit import gtfs_realtime_pb2
 import os
 import sys
+import threading
+import time
+from typing import NamedTuple
+try:
+    import fcntl
+except ImportError:     # Windows, SHARED_FEED is not available there
+    fcntl = None
 
 # API Layer
 
-GTFS_DB = "gtfs.db"
 URL = "https://api.opendata.transport.vic.gov.au/opendata/public-transport/gtfs/realtime/v1/metro/trip-updates"
 
 KEY_FILE = "api_key.txt"
 
+FEED_TTL = 20           # seconds a downloaded feed is served before it gets refreshed
+FEED_MAX_AGE = 300      # seconds after which a stale feed is no longer shown to users
+FEED_TIMEOUT = 10       # seconds a request waits for the first feed when none is cached
+FEED_CONNECT_TIMEOUT = 5    # seconds to connect to the upstream realtime endpoint
+FEED_READ_TIMEOUT = 10      # seconds to wait for its response
+FEED_RETRIES = 3            # attempts per refresh on network errors / 5xx
+FEED_BACKOFF = 0.5          # seconds before the first retry, doubled after every attempt
+SERVICE_DAY_OVERLAP = 6 * 3600  # seconds past 24:00 that trips of the previous service day may still run
+
+SHARED_FEED = os.environ.get("SHARED_FEED", "0") == "1"    # workers share one download through SNAPSHOT_FILE
+SNAPSHOT_FILE = "realtime.snapshot"     # last indexed feed, restored at startup and shared between workers
+LEADER_LOCK = "realtime.lock"           # flock held by the worker that downloads the feed
+FOLLOW_INTERVAL = 1                     # seconds between checks of SNAPSHOT_FILE by the other workers
+RESTORED_MAX_AGE = 30 * 60              # seconds a snapshot restored at startup is shown while upstream is down
+
 def load_api_key():
     '''
-    If "api_key.txt" doesn't exist, create it and exit
-    Otherwise, return key
+    If "api_key.txt" doesn't exist, create it with a placeholder
+    Return (key, whether the key is usable)
     '''
     key_placeholder = "PUT_YOUR_API_KEY_HERE"
     if not os.path.exists(KEY_FILE): 
         with open(KEY_FILE, "w") as f:  f.write(key_placeholder)
+        key = key_placeholder
     else:
         with open(KEY_FILE, "r") as f:  key = f.read().strip()
     
     status = False if not key or key == key_placeholder else True
     return key, status
 
-API_KEY, status = load_api_key()
+_api_key = {}   # key, status of api_key.txt once read
+
+def get_api_key():
+    '''
+    (key, status) of api_key.txt, read on first use rather than at import.
+    '''
+    if not _api_key:
+        _api_key["key"], _api_key["status"] = load_api_key()
+    return _api_key["key"], _api_key["status"]
+
+def feed_headers():
+    return { "KeyId": get_api_key()[0], "Accept-Encoding": "gzip" }
 
-HEADERS = { "KeyId": API_KEY }
 MELBOURNE = ZoneInfo("Australia/Melbourne") # GTFS uses GMT+0, default to Melbourne Timezone
 
 SCHEDULE_ENUM = {   # Enum used in GTFS
@@ -48,112 +85,581 @@ def load_stop_lookup():
     '''
     Uses the dataset to lookup corresponding stop_id to readable Station Name.
     '''
-    conn = sqlite3.connect(GTFS_DB)
-    cur = conn.cursor()
-    cur.execute("SELECT stop_id, stop_name, platform_code FROM stops")
+    cur = db_pool.get_conn().execute("SELECT stop_id, stop_name, platform_code, parent_station FROM stops")
     lookup = {
-        stop_id: {"name": stop_name, "platform": platform_code}
-        for stop_id, stop_name, platform_code in cur.fetchall()
+        stop_id: {"name": stop_name, "platform": platform_code, "parent": parent_station}
+        for stop_id, stop_name, platform_code, parent_station in cur.fetchall()
     }
-    conn.close()
     return lookup
 
-def load_scheduled_times(trip_id):
+def build_station_stops(lookup):
     '''
-    Return scheduled time based on the GTFS datasets with operational hours,
-    where same operation day over midnight is displayed beyond 24:00 even it is a new day
-    (e.g. 01:02 of 23/01 will be 25:02 22/01), display will unitfy to show 00:00 - 23:59
+    {parent stop_id: [platform stop_ids]} from load_stop_lookup()
     '''
-    conn = sqlite3.connect(GTFS_DB)
-    cur = conn.cursor()
-    cur.execute("SELECT stop_id, arrival_time FROM stop_times WHERE trip_id = ?", (trip_id,))
-    schedule = {}
-    service_day = datetime.now(MELBOURNE).replace(hour=0, minute=0, second=0, microsecond=0)
-    for stop_id, arrival_time in cur.fetchall():
-        if not arrival_time:
-            continue
-        h, m, s = map(int, arrival_time.split(":"))
-        total_seconds = h * 3600 + m * 60 + s
-        schedule[stop_id] = service_day + timedelta(seconds=total_seconds)
-    conn.close()
-    return schedule
+    station_stops = {}
+    for stop_id, info in lookup.items():
+        if info["parent"]:
+            station_stops.setdefault(info["parent"], []).append(stop_id)
+    return station_stops
+
+def service_day_start(service_date):
+    '''
+    Epoch of "noon minus 12h" of a service date in Melbourne, the zero point GTFS times count from
+    (midnight, except on daylight saving change days).
+    '''
+    noon = datetime(service_date.year, service_date.month, service_date.day, 12, tzinfo=MELBOURNE)
+    return int(noon.timestamp()) - 12 * 3600
 
-STOP_LOOKUP = load_stop_lookup()
+def service_days(now):
+    '''
+    Service days running at epoch `now` as [(service_date, service_day_start)]: today, plus yesterday
+    for SERVICE_DAY_OVERLAP after midnight, as its trips are timed past 24:00 (e.g. 25:02 for 01:02).
+    '''
+    today = datetime.fromtimestamp(now, tz=MELBOURNE).date()
+    days = [(today, service_day_start(today))]
+    if now - days[0][1] < SERVICE_DAY_OVERLAP:
+        yesterday = today - timedelta(days=1)
+        days.append((yesterday, service_day_start(yesterday)))
+    return days
+
+@metrics.timed("schedule_sql")
+def load_scheduled_times(trip_ids, stop_ids, day_starts=None):
+    '''
+    Scheduled arrival of many trips at the given stops in a single query, {(trip_id, stop_id): epoch seconds}.
+    Arrival times (seconds of the service day) are added onto the trip's service_day_start from day_starts
+    ({trip_id: epoch}), today's service day for trips not in it.
+    '''
+    if not trip_ids or not stop_ids:
+        return {}
+
+    q = f"""
+    SELECT trip_id, stop_id, arrival_time
+    FROM stop_times
+    WHERE trip_id IN ({','.join('?' * len(trip_ids))})
+      AND stop_id IN ({','.join('?' * len(stop_ids))})
+    """
+    day_starts = day_starts or {}
+    today = service_day_start(datetime.now(MELBOURNE).date())
+    return {
+        (trip_id, stop_id): day_starts.get(trip_id, today) + arrival_time
+        for trip_id, stop_id, arrival_time in db_pool.get_conn().execute(q, (*trip_ids, *stop_ids))
+        if arrival_time is not None
+    }
+
+STOP_LOOKUP = None      # loaded on first use by get_station_stops(), not at import
+STATION_STOPS = None
+
+def get_station_stops():
+    '''
+    {parent stop_id: [platform stop_ids]}, read from gtfs.db on first use and after every reload.
+    '''
+    global STOP_LOOKUP, STATION_STOPS
+    if STATION_STOPS is None:
+        STOP_LOOKUP = load_stop_lookup()
+        STATION_STOPS = build_station_stops(STOP_LOOKUP)
+    return STATION_STOPS
+
+def reset_caches():
+    '''
+    Forget everything read from gtfs.db, called after the database has been swapped.
+    '''
+    global STOP_LOOKUP, STATION_STOPS
+    STOP_LOOKUP = STATION_STOPS = None
 
 def calculate_delay(rt_time, sched_time):
+    '''
+    Delay in whole minutes between two epoch times
+    '''
     if not rt_time or not sched_time: return None
-    delay_min = int((rt_time - sched_time).total_seconds() / 60)
+    delay_min = int((rt_time - sched_time) / 60)
     return delay_min
 
+# =====================
+# REALTIME FEED CACHE
+# =====================
+class FeedSnapshot(NamedTuple):
+    '''
+    Published realtime state, replaced as a whole and never mutated, so requests read it without locking.
+    '''
+    index: dict | None      # build_feed_index() of the feed (or a feed_snapshot.MappedIndex), None before the first download
+    timestamp: int          # header.timestamp of the feed
+    fetched_at: float       # time.monotonic() of the last download that confirmed it
+    version: int            # bumped only when the feed content changed
+    restored: bool = False  # loaded from SNAPSHOT_FILE at startup, not yet confirmed by a download
+
+SNAPSHOT = FeedSnapshot(None, 0, 0.0, 0)
+
+FEED_STATS = {             # counters of the upstream traffic, see feed_stats()
+    "requests": 0,          # responses received from upstream
+    "not_modified": 0,      # 304 answers to a conditional request
+    "bytes_downloaded": 0,  # bytes on the wire (compressed)
+    "bytes_decoded": 0,     # protobuf bytes after decompression
+    "parses": 0,            # feeds parsed
+    "skipped_parses": 0,    # identical bodies not parsed again
+    "skipped_indexes": 0,   # parsed feeds with an unchanged header.timestamp, not re-indexed
+}
+_validators = {"etag": None, "last_modified": None, "digest": None}
+
+_feed_lock = threading.Lock()
+_feed_refreshed = threading.Condition(_feed_lock)
+_feed_refreshing = False
+_poller_running = False
+
+def conditional_headers():
+    '''
+    If-None-Match / If-Modified-Since of the feed currently published, so an unchanged feed costs a 304.
+    '''
+    headers = {}
+    if SNAPSHOT.index is None:
+        return headers
+    if _validators["etag"]:
+        headers["If-None-Match"] = _validators["etag"]
+    if _validators["last_modified"]:
+        headers["If-Modified-Since"] = _validators["last_modified"]
+    return headers
+
+def fetch_feed():
+    '''
+    Conditional download of the realtime trip-updates feed, None if upstream is unavailable.
+    '''
+    try:
+        with metrics.timer("feed_download"):
+            response = requests.get(URL, headers={**feed_headers(), **conditional_headers()},
+                                    timeout=(FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT), stream=True)
+            content = response.content
+    except requests.RequestException:
+        return None
+    wire_bytes = response.raw.tell() or len(content)     # body size before requests decoded the gzip
+    return response.status_code, response.headers, content, wire_bytes
+
+_async_client = None
+
+def get_async_client():
+    '''
+    Shared httpx client, so connections to the upstream endpoint are kept alive between refreshes.
+    '''
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            headers=feed_headers(),
+            timeout=httpx.Timeout(FEED_READ_TIMEOUT, connect=FEED_CONNECT_TIMEOUT),
+        )
+    return _async_client
+
+async def close_async_client():
+    if _async_client is not None:
+        await _async_client.aclose()
+
+async def fetch_feed_async():
+    '''
+    Async download of the realtime feed, retried with exponential backoff on network errors and 5xx.
+    Returns the last httpx response (429 is returned straight away so the caller can back off),
+    None if upstream could not be reached at all.
+    '''
+    client = get_async_client()
+    response = None
+    for attempt in range(FEED_RETRIES):
+        if attempt:
+            await asyncio.sleep(FEED_BACKOFF * 2 ** (attempt - 1))
+        try:
+            with metrics.timer("feed_download"):
+                response = await client.get(URL, headers=conditional_headers())
+        except httpx.TransportError:
+            continue
+        if response.status_code < 500:
+            break
+    return response
+
+@metrics.timed("feed_parse")
+def parse_feed(content):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return feed
+
+@metrics.timed("feed_index")
+def build_feed_index(feed):
+    '''
+    Walk the feed once and index it as {trip_id: {stop_id: (arrival, departure, relationship)}},
+    arrival/departure are epoch seconds (0 when not given), relationship is None when not given.
+    Only the first trip update of a trip is kept, same as the old linear scan.
+    '''
+    index = {}
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        tu = entity.trip_update
+        if tu.trip.trip_id in index:
+            continue
+
+        stops = {}
+        for stu in tu.stop_time_update:
+            arrival = stu.arrival.time if stu.HasField("arrival") else 0
+            departure = stu.departure.time if stu.HasField("departure") else 0
+            relationship = stu.schedule_relationship if stu.HasField("schedule_relationship") else None
+            stops.setdefault(stu.stop_id, (arrival, departure, relationship))
+        index[tu.trip.trip_id] = stops
+    return index
+
+def receive_feed(status_code, headers, content, wire_bytes):
+    '''
+    Account for an upstream response and publish its feed, unless upstream answered 304
+    or sent back exactly the bytes already published (then the snapshot is only confirmed as fresh).
+    '''
+    FEED_STATS["requests"] += 1
+    FEED_STATS["bytes_downloaded"] += wire_bytes
+    if status_code == 304:
+        FEED_STATS["not_modified"] += 1
+        confirm_feed()
+        return
+    if status_code != 200:
+        return
+
+    FEED_STATS["bytes_decoded"] += len(content)
+    validators = {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    if SNAPSHOT.index is not None and digest == _validators["digest"]:
+        FEED_STATS["skipped_parses"] += 1
+        _validators.update(validators)
+        confirm_feed()
+        return
+
+    feed = parse_feed(content)
+    FEED_STATS["parses"] += 1
+    publish_feed(feed)
+    # only kept once published: a corrupt body must not be answered with 304 from then on
+    _validators.update(validators, digest=digest)
+
+def receive_response(response):
+    '''
+    receive_feed() for an httpx response, num_bytes_downloaded is the size before gzip decoding.
+    '''
+    receive_feed(response.status_code, response.headers, response.content, response.num_bytes_downloaded)
+
+def confirm_feed():
+    global SNAPSHOT
+    SNAPSHOT = SNAPSHOT._replace(fetched_at=time.monotonic(), restored=False)
+
+def feed_stats():
+    return dict(FEED_STATS)
+
+metrics.register_counters("feed", feed_stats)
+
+def publish_feed(feed):
+    '''
+    Make a freshly downloaded feed the new SNAPSHOT.
+    A feed whose header.timestamp did not move is not re-indexed, only its fetched_at is refreshed.
+    Only called by the single in-flight refresh, so there is never more than one writer.
+    '''
+    global SNAPSHOT
+    now = time.monotonic()
+    timestamp = feed.header.timestamp
+    if SNAPSHOT.index is not None and timestamp and timestamp == SNAPSHOT.timestamp:
+        FEED_STATS["skipped_indexes"] += 1
+        SNAPSHOT = SNAPSHOT._replace(fetched_at=now, restored=False)
+    else:
+        SNAPSHOT = FeedSnapshot(build_feed_index(feed), timestamp, now, SNAPSHOT.version + 1)
+
+def _refresh_done():
+    global _feed_refreshing
+    with _feed_lock:
+        _feed_refreshing = False
+        _feed_refreshed.notify_all()
+
+def _usable_index():
+    snapshot = SNAPSHOT
+    age = time.monotonic() - snapshot.fetched_at
+    return snapshot.index if age < (RESTORED_MAX_AGE if snapshot.restored else FEED_MAX_AGE) else None
+
+def feed_age():
+    '''
+    Seconds since the published feed was last confirmed by upstream, None when no feed is shown.
+    '''
+    if _usable_index() is None:
+        return None
+    return int(time.monotonic() - SNAPSHOT.fetched_at)
+
+def _refresh_feed():
+    '''
+    Runs in a background thread, only one refresh at a time (guarded by _feed_refreshing).
+    '''
+    try:
+        response = fetch_feed()
+        if response is not None:
+            receive_feed(*response)
+    finally:
+        _refresh_done()
+
+async def _refresh_feed_async():
+    '''
+    Async counterpart of _refresh_feed, parsing/indexing runs in a worker thread to keep the event loop free.
+    '''
+    try:
+        response = await fetch_feed_async()
+        if response is not None:
+            await asyncio.to_thread(receive_response, response)
+    finally:
+        _refresh_done()
+
+def get_feed_index():
+    '''
+    Process-wide indexed realtime feed shared by every request.
+    With the background poller running this only reads SNAPSHOT. Otherwise (CLI, scripts):
+    - Fresh feed (younger than FEED_TTL) is returned as is
+    - Stale feed is returned straight away while a single background refresh runs
+    - With no usable feed, callers wait for the in-flight download instead of starting their own
+    '''
+    global _feed_refreshing
+    if _poller_running:
+        return _usable_index()
+
+    with _feed_lock:
+        age = time.monotonic() - SNAPSHOT.fetched_at
+        index = _usable_index()
+        if index is not None and age < FEED_TTL:
+            return index
+
+        if not _feed_refreshing:
+            _feed_refreshing = True
+            threading.Thread(target=_refresh_feed, daemon=True).start()
+        if index is not None:
+            return index
+
+        _feed_refreshed.wait_for(lambda: not _feed_refreshing, timeout=FEED_TIMEOUT)
+        return _usable_index()
+
+def _wait_for_refresh():
+    with _feed_lock:
+        _feed_refreshed.wait_for(lambda: not _feed_refreshing, timeout=FEED_TIMEOUT)
+
+_feed_task = None
+
+async def get_feed_index_async():
+    '''
+    Same as get_feed_index() for async handlers: the refresh runs as an asyncio task on the shared
+    httpx client, and waiting for a cold download never blocks the event loop or a worker thread.
+    '''
+    global _feed_refreshing, _feed_task
+    if _poller_running:
+        return _usable_index()
+
+    with _feed_lock:
+        age = time.monotonic() - SNAPSHOT.fetched_at
+        index = _usable_index()
+        if index is not None and age < FEED_TTL:
+            return index
+
+        if not _feed_refreshing:
+            _feed_refreshing = True
+            _feed_task = asyncio.create_task(_refresh_feed_async())
+        task = _feed_task
+    if index is not None:
+        return index
+
+    if task is not None and not task.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(task), FEED_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+    else:
+        await asyncio.to_thread(_wait_for_refresh)     # refresh started by a sync caller
+    return _usable_index()
+
+def retry_after(response, default):
+    '''
+    Seconds asked for by a 429 Retry-After header (delta-seconds form), default otherwise.
+    '''
+    try:
+        return max(float(response.headers.get("Retry-After", default)), default)
+    except ValueError:
+        return default
+
+_leader = {"lock": None}   # open LEADER_LOCK file while this process is the leader
+
+def try_lead():
+    '''
+    Become the one worker downloading the feed for all of them (non-blocking flock on LEADER_LOCK).
+    The OS releases the lock when the leader exits, then the next worker to try takes over.
+    '''
+    if fcntl is None:
+        return True
+    if _leader["lock"] is None:
+        f = open(LEADER_LOCK, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        _leader["lock"] = f
+    return True
+
+def save_snapshot(previous):
+    '''
+    Write SNAPSHOT to SNAPSHOT_FILE when its content changed since `previous`,
+    only touch the file when the feed was confirmed unchanged (the mtime tells its age).
+    '''
+    snapshot = SNAPSHOT
+    if snapshot.index is None or snapshot.restored:
+        return
+    if snapshot.version != previous.version or not os.path.exists(SNAPSHOT_FILE):
+        feed_snapshot.write_snapshot(SNAPSHOT_FILE, snapshot.index, snapshot.version, snapshot.timestamp)
+    elif snapshot.fetched_at != previous.fetched_at:
+        os.utime(SNAPSHOT_FILE)
+
+def load_shared_snapshot(last, restored=False):
+    '''
+    Publish SNAPSHOT_FILE as SNAPSHOT (memory-mapped, not parsed) if it changed since `last`,
+    its (inode, mtime) when it was loaded. Returns the identity of the file now published.
+    Used by follower workers, and with restored=True to start from the last feed after a restart.
+    '''
+    global SNAPSHOT
+    try:
+        stat = os.stat(SNAPSHOT_FILE)
+    except FileNotFoundError:
+        return last
+    identity = (stat.st_ino, stat.st_mtime_ns)
+    if identity == last:
+        return last
+
+    fetched_at = time.monotonic() - max(time.time() - stat.st_mtime, 0)
+    if last is None or identity[0] != last[0]:
+        index = feed_snapshot.MappedIndex(SNAPSHOT_FILE)
+        SNAPSHOT = FeedSnapshot(index, index.timestamp, fetched_at, index.version, restored)
+    else:
+        SNAPSHOT = SNAPSHOT._replace(fetched_at=fetched_at, restored=restored)
+    return identity
+
+async def poll_feed():
+    '''
+    Background task started with the app (see startup.lifespan): downloads the feed every FEED_TTL
+    seconds and publishes it as SNAPSHOT, so requests never wait on upstream.
+    Backs off as asked on 429, unchanged feeds are caught by receive_feed() and not parsed again.
+    Every new feed is saved to SNAPSHOT_FILE, the last one is restored first so boards are warm after a restart.
+    With SHARED_FEED only the leader worker downloads, the others follow SNAPSHOT_FILE.
+    '''
+    global _poller_running
+    _poller_running = True
+    loop = asyncio.get_running_loop()
+    shared = None
+    if SNAPSHOT.index is None:
+        try:
+            shared = await asyncio.to_thread(load_shared_snapshot, None, True)
+        except Exception:
+            pass    # unreadable or old format, start cold
+    try:
+        while True:
+            if SHARED_FEED and not try_lead():
+                try:
+                    shared = await asyncio.to_thread(load_shared_snapshot, shared)
+                except Exception:
+                    pass    # e.g. a file being replaced, retried on the next check
+                await asyncio.sleep(FOLLOW_INTERVAL)
+                continue
+
+            next_poll = loop.time() + FEED_TTL
+            previous = SNAPSHOT
+            try:
+                response = await fetch_feed_async()
+                if response is not None:
+                    await asyncio.to_thread(receive_response, response)
+                await asyncio.to_thread(save_snapshot, previous)
+                if response is not None and response.status_code == 429:
+                    next_poll = loop.time() + retry_after(response, FEED_TTL)
+            except Exception:
+                pass    # a bad download must never stop the poller, the last snapshot stays published
+            await asyncio.sleep(max(next_poll - loop.time(), 0))
+    finally:
+        _poller_running = False
+
+def feed_version():
+    '''
+    Changes every time a feed with new content is published, 0 before the first one.
+    '''
+    return SNAPSHOT.version
+
 # =====================
 # MAIN FUNCTIONS
 # =====================
-def return_trip_realtime(trip_ids, station_name, feed):
+@metrics.timed("realtime_overlay")
+def return_trip_realtime(trip_ids, station_id, feed_index, schedule_map=None):
     """
-    Returns simplified realtime info for multiple trips at a given station.
+    Returns simplified realtime info for multiple trips at a given station (parent stop_id).
     Returns a dict: {trip_id: list of dicts per stop with keys: relationship, scheduled, realtime, delay}
+    scheduled/realtime are epoch seconds (None when unknown), formatting is left to the API layer.
+    schedule_map can be passed in when it was already loaded for several stations at once.
     """
     result = {}
+    station_stops = get_station_stops().get(station_id, [])
+    if schedule_map is None:
+        found = [trip_id for trip_id in trip_ids if trip_id in feed_index]
+        schedule_map = load_scheduled_times(found, station_stops)
+
     for trip_id in trip_ids:
-        schedule_map = load_scheduled_times(trip_id)
-        trip_found = False
         trip_stops = []
+        realtime_stops = feed_index.get(trip_id)
+        if realtime_stops is None:
+            result[trip_id] = trip_stops
+            continue
 
-        for entity in feed.entity:
-            if not entity.HasField("trip_update"):
-                continue
-            tu = entity.trip_update
-            if tu.trip.trip_id != trip_id:
+        for stop_id in station_stops:
+            if stop_id not in realtime_stops:
                 continue
+            arrival, departure, relationship = realtime_stops[stop_id]
 
-            trip_found = True
-            for stu in tu.stop_time_update:
-                stop_info = STOP_LOOKUP.get(stu.stop_id, {})
-                stop_name_real = stop_info.get("name", stu.stop_id)
-                if station_name.lower() not in stop_name_real.lower():
-                    continue
+            # Realtime time
+            rt_time = arrival or departure or None
+            sched_time = schedule_map.get((trip_id, stop_id))
 
-                # Realtime time
-                rt_time = None
-                if stu.HasField("arrival") and stu.arrival.time:        rt_time = datetime.fromtimestamp(stu.arrival.time, tz=timezone.utc).astimezone(MELBOURNE)
-                elif stu.HasField("departure") and stu.departure.time:  rt_time = datetime.fromtimestamp(stu.departure.time, tz=timezone.utc).astimezone(MELBOURNE)
+            relationship = SCHEDULE_ENUM.get(relationship, "UNKNOWN") if relationship is not None else "UNKNOWN"
+            delay_int = calculate_delay(rt_time, sched_time)
 
-                sched_time = schedule_map.get(stu.stop_id)
-                sched_str = sched_time.strftime("%H:%M") if sched_time else "N/A"
-                rt_str = rt_time.strftime("%H:%M") if rt_time else "N/A"
+            trip_stops.append({
+                "relationship": relationship,
+                "scheduled": sched_time,
+                "realtime": rt_time,
+                "delay": delay_int
+            })
 
-                relationship = SCHEDULE_ENUM.get(stu.schedule_relationship, "UNKNOWN") if stu.HasField("schedule_relationship") else "UNKNOWN"
-                delay_int = calculate_delay(rt_time, sched_time)
-
-                trip_stops.append({
-                    "relationship": relationship,
-                    "scheduled": sched_str,
-                    "realtime": rt_str,
-                    "delay": delay_int
-                })
-
-            break  # stop after first matching trip update
-
-        result[trip_id] = trip_stops if trip_found else []
+        result[trip_id] = trip_stops
 
     return result
 
 
-def enquiry(station_name: str, trip_id_lst):
+def enquiry(station_id: str, trip_id_lst, day_starts=None):
     '''
-    Takes User input and Real Time info into the format for gtfs_query.py
+    Takes the station's parent stop_id and Real Time info into the format for gtfs_query.py
+    day_starts: {trip_id: service_day_start} for trips not running on today's service day
     '''
-    station_name_input = station_name.strip()
     trip_ids_input = [tid.strip() for tid in trip_id_lst if tid.strip()]
 
-    response = requests.get(URL, headers=HEADERS)
-    if response.status_code != 200:
+    feed_index = get_feed_index()
+    if feed_index is None:
         return None
 
-    feed = gtfs_realtime_pb2.FeedMessage()
-    feed.ParseFromString(response.content)
-
     # Get realtime info
-    trips_data = return_trip_realtime(trip_ids_input, station_name_input, feed)
+    found = [trip_id for trip_id in trip_ids_input if trip_id in feed_index]
+    schedule_map = load_scheduled_times(found, get_station_stops().get(station_id, []), day_starts)
+    trips_data = return_trip_realtime(trip_ids_input, station_id, feed_index, schedule_map)
+
+    return trips_data
+
+def enquiry_many(station_trips, day_starts=None):
+    '''
+    enquiry() for several stations at once, {station_id: trip_id_lst} -> {station_id: trips_data}.
+    All stations are overlaid with the same realtime snapshot and their scheduled times come from one query.
+    '''
+    feed_index = get_feed_index()
+    if feed_index is None:
+        return {station_id: None for station_id in station_trips}
+
+    station_trips = {
+        station_id: [tid.strip() for tid in trip_id_lst if tid.strip()]
+        for station_id, trip_id_lst in station_trips.items()
+    }
+    found = {tid for trip_ids in station_trips.values() for tid in trip_ids if tid in feed_index}
+    stops = {stop_id for station_id in station_trips for stop_id in get_station_stops().get(station_id, [])}
+    schedule_map = load_scheduled_times(sorted(found), sorted(stops), day_starts)
 
-    return trips_data
\ No newline at end of file
+    return {
+        station_id: return_trip_realtime(trip_ids, station_id, feed_index, schedule_map)
+        for station_id, trip_ids in station_trips.items()
+    }
@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import threading
+
+# Database Layer
+
+DB_FILE = "gtfs.db"
+
+MMAP_SIZE = 256 * 1024 * 1024   # bytes of gtfs.db memory-mapped, shared through the OS page cache
+CACHE_SIZE = -16000             # per connection page cache in KiB (negative = KiB in SQLite)
+CACHED_STATEMENTS = 256         # prepared statements kept per connection
+
+class PooledConnection(sqlite3.Connection):
+    '''
+    sqlite3 connection tagged with the database generation it was opened on,
+    so caches built from it can tell whether they belong to the current gtfs.db.
+    '''
+    generation = 0
+
+_local = threading.local()
+_lock = threading.Lock()
+_state = {"version": None, "generation": 0}
+_reload_callbacks = []
+
+def connect(db_file=DB_FILE):
+    '''
+    Open a tuned read-only connection.
+    '''
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, factory=PooledConnection,
+                           cached_statements=CACHED_STATEMENTS)
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = {CACHE_SIZE}")
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+def db_version():
+    '''
+    Identity of the current gtfs.db file, changes whenever it is rebuilt, swapped or updated.
+    '''
+    stat = os.stat(DB_FILE)
+    return (stat.st_ino, stat.st_mtime_ns)
+
+def on_reload(callback):
+    '''
+    Register a function called (without arguments) whenever a new gtfs.db is detected.
+    '''
+    _reload_callbacks.append(callback)
+
+def check_version():
+    '''
+    Detect gtfs.db being replaced or modified (also by startup.py --rebuild/--update in another process),
+    bump the generation so every thread reopens its connection, and run the reload callbacks once.
+    '''
+    version = db_version()
+    if version == _state["version"]:
+        return
+    with _lock:
+        if version == _state["version"]:
+            return
+        first_load = _state["version"] is None
+        _state["version"] = version
+        _state["generation"] += 1
+    if not first_load:
+        for callback in _reload_callbacks:
+            callback()
+
+def generation():
+    return _state["generation"]
+
+def get_conn():
+    '''
+    Persistent connection of the calling thread, reopened when gtfs.db changes.
+    Statement and page caches survive across requests served by the same worker thread.
+    '''
+    check_version()
+    conn = getattr(_local, "conn", None)
+    if conn is None or conn.generation != _state["generation"]:
+        if conn is not None:
+            conn.close()
+        conn = connect()
+        conn.generation = _state["generation"]
+        _local.conn = conn
+    return conn
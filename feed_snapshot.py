@@ -0,0 +1,104 @@
+import mmap
+import os
+import struct
+
+# Realtime Snapshot File
+
+# Indexed realtime feed (current_trips.build_feed_index) as a flat binary file:
+# header, trips sorted by trip_id, their stop updates, then the trip/stop id strings.
+MAGIC = b"NTRT"
+FORMAT = 1
+HEADER = struct.Struct("<4sIqqII")  # magic, format, feed version, feed header.timestamp, trips, stop updates
+TRIP = struct.Struct("<IHII")       # trip_id offset, trip_id length, first stop update, stop updates
+STOP = struct.Struct("<IHqqi")      # stop_id offset, stop_id length, arrival, departure, relationship (-1 = none)
+
+def write_snapshot(path, index, version, timestamp):
+    '''
+    Write a feed index to `path` atomically (temporary file + os.replace), so readers that mapped
+    the previous file keep a consistent view until they reload.
+    '''
+    strings = bytearray()
+    offsets = {}
+
+    def intern(value):
+        value = value.encode()
+        offset = offsets.get(value)
+        if offset is None:
+            offset = offsets[value] = len(strings)
+            strings.extend(value)
+        return offset, len(value)
+
+    trips = bytearray()
+    stops = bytearray()
+    n_stops = 0
+    for trip_id in sorted(index, key=str.encode):
+        stop_updates = index[trip_id]
+        trips += TRIP.pack(*intern(trip_id), n_stops, len(stop_updates))
+        for stop_id, (arrival, departure, relationship) in stop_updates.items():
+            stops += STOP.pack(*intern(stop_id), arrival, departure, -1 if relationship is None else relationship)
+        n_stops += len(stop_updates)
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT, version, timestamp, len(index), n_stops))
+        f.write(trips)
+        f.write(stops)
+        f.write(strings)
+    os.replace(tmp, path)
+
+class MappedIndex:
+    '''
+    Read-only, memory-mapped snapshot file used in place of the build_feed_index() dict
+    (supports `in`, get() and len()). Trips are found by binary search in the mapping, so every
+    process mapping the same file shares its pages instead of holding its own copy.
+    '''
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, self.version, self.timestamp, self._n_trips, n_stops = HEADER.unpack_from(self._map)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError(f"{path} is not a realtime snapshot")
+        self._trips = HEADER.size
+        self._stops = self._trips + TRIP.size * self._n_trips
+        self._strings = self._stops + STOP.size * n_stops
+
+    def _string(self, offset, length):
+        start = self._strings + offset
+        return self._map[start:start + length]
+
+    def _find(self, trip_id):
+        key = trip_id.encode()
+        lo, hi = 0, self._n_trips
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, first, count = TRIP.unpack_from(self._map, self._trips + mid * TRIP.size)
+            if self._string(offset, length) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_trips:
+            offset, length, first, count = TRIP.unpack_from(self._map, self._trips + lo * TRIP.size)
+            if self._string(offset, length) == key:
+                return first, count
+        return None
+
+    def __len__(self):
+        return self._n_trips
+
+    def __contains__(self, trip_id):
+        return self._find(trip_id) is not None
+
+    def get(self, trip_id, default=None):
+        '''
+        {stop_id: (arrival, departure, relationship)} of a trip, same as the dict index.
+        '''
+        found = self._find(trip_id)
+        if found is None:
+            return default
+        first, count = found
+        stops = {}
+        for i in range(first, first + count):
+            offset, length, arrival, departure, relationship = STOP.unpack_from(self._map, self._stops + i * STOP.size)
+            stops[self._string(offset, length).decode()] = (arrival, departure, None if relationship < 0 else relationship)
+        return stops
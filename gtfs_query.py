@@ -1,11 +1,17 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from bisect import bisect_left
 import sqlite3
 import csv
-from datetime import datetime, timedelta
+import hashlib
+from datetime import datetime
 import os
 import time
+import threading
 from fastapi import FastAPI
 import current_trips
+import db_pool
+import metrics
+import timetable
 
 # Main Logic
 
@@ -29,78 +35,84 @@ CITY_STATIONS = [
     "Southern Cross Station"
 ]
 
-def find_next_trip_in_block(conn, block_id, current_trip_id):
+MAX_PER_PLATFORM = 12   # scheduled departures taken per platform before realtime/organise()
+DEPARTED_WINDOW = 3 * 60    # seconds a departed train is still taken from the timetable
+TIMETABLE_ENGINE = os.environ.get("TIMETABLE_ENGINE", "sqlite")  # "sqlite": rows built by build_departure_boards()
+                                                                # "array": columnar timetable.Timetable
+RESPONSE_CACHE_SIZE = 256   # station boards kept by the response cache (least recently used dropped first)
+
+def reset_caches():
     '''
-    find the next trip of the same block (same physical train)
+    Drop every cache built from gtfs.db, called by db_pool when the database file changes.
     '''
-    if not block_id:
-        return None
-
-    q = """
-    SELECT t.trip_headsign, MIN(st.departure_time), t.direction_id
+    global _network
+    _boards.update(key=None, days={}, successors={})
+    _network = (None, None)
+    with _responses_lock:
+        _responses.clear()
+    _stations.clear()
+    current_trips.reset_caches()
+
+# Next trip of the same block (same physical train) for every trip, ordered by first departure.
+# Materialised as the block_successors table at import (see startup.build_derived_tables).
+BLOCK_SUCCESSORS_QUERY = """
+WITH first_departures AS (
+    SELECT t.trip_id, t.block_id, t.service_id, t.trip_headsign, t.direction_id,
+           MIN(st.departure_time) AS first_departure
     FROM trips t
     JOIN stop_times st ON t.trip_id = st.trip_id
-    WHERE t.block_id = ?
-      AND t.trip_id != ?
+    WHERE t.block_id IS NOT NULL AND t.block_id != ''
     GROUP BY t.trip_id
-    ORDER BY MIN(st.departure_time)
-    LIMIT 1
-    """
-    return conn.execute(q, (block_id, current_trip_id)).fetchone()
+),
+ordered AS (
+    SELECT
+        trip_id,
+        LEAD(trip_id) OVER block_order AS next_trip_id,
+        LEAD(trip_headsign) OVER block_order AS next_headsign,
+        LEAD(first_departure) OVER block_order AS next_departure,
+        LEAD(direction_id) OVER block_order AS next_direction_id
+    FROM first_departures
+    WINDOW block_order AS (PARTITION BY block_id, service_id ORDER BY first_departure)
+)
+SELECT trip_id, next_trip_id, next_headsign, next_departure, next_direction_id
+FROM ordered
+WHERE next_trip_id IS NOT NULL
+"""
 
-def time_str_to_min(time_str):
+def load_block_successors(conn):
+    '''
+    {trip_id: (next_headsign, next_departure, next_direction_id)}, computed on the fly for databases built before block_successors existed
+    '''
+    try:
+        rows = conn.execute("SELECT trip_id, next_headsign, next_departure, next_direction_id FROM block_successors").fetchall()
+    except sqlite3.OperationalError:
+        rows = [(r[0], *r[2:]) for r in conn.execute(BLOCK_SUCCESSORS_QUERY)]
+    return {trip_id: tuple(rest) for trip_id, *rest in rows}
+
+@metrics.timed("next_trip_in_block")
+def find_next_trip_in_block(trip_id):
     '''
-    parse time string into minutes with difference formats
+    find the next trip of the same block (same physical train): (headsign, first departure, direction_id) or None
     '''
-    parts = list(map(int, time_str.split(":")))
-    if len(parts) == 2:
-        h, m = parts
-        s = 0
-    elif len(parts) == 3:
-        h, m, s = parts
-    else:
-        raise ValueError(f"Invalid time string: {time_str}")
-    return h * 60 + m
+    return _boards["successors"].get(trip_id)
 
-def minutes_until(departure_time_str, now_str):
+def seconds_to_time_str(seconds):
     """
-    Handles both GTFS (24:xx, 25:xx) and realtime (00:xx next-day)
+    Format seconds since the start of the service day (as stored in gtfs.db) back into GTFS HH:MM:SS.
     """
-    dep_parts = list(map(int, departure_time_str.split(":")))
-    now_parts = list(map(int, now_str.split(":")))
-
-    dep_h, dep_m = dep_parts[0], dep_parts[1]
-    now_h, now_m = now_parts[0], now_parts[1]
-
-    dep_total = dep_h * 60 + dep_m
-    now_total = now_h * 60 + now_m
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
 
-    # assume it's next day if departure hour < 3 AND current hour >= 21
-    if dep_h < 3 and now_h >= 21: dep_total += 24 * 60
-    return dep_total - now_total
-
-def format_time_display(time_str):
+def format_epoch(epoch):
     """
-    Format HH:MM:SS or HH:MM (possibly >24h) into standard 00:00–23:59 time.
+    Epoch seconds into Melbourne HH:MM, only used when building the API response.
     """
-    parts = list(map(int, time_str.split(":")))
-    
-    if len(parts) == 3:
-        h, m, s = parts
-    elif len(parts) == 2:
-        h, m = parts
-        s = 0
-    else:
-        raise ValueError(f"Invalid time format: {time_str}")
-
-    total_minutes = h * 60 + m
-    total_minutes %= 24 * 60  # wrap around 24h
-
-    new_h = total_minutes // 60
-    new_m = total_minutes % 60
-
-    return f"{new_h:02d}:{new_m:02d}"
+    return datetime.fromtimestamp(epoch, tz=current_trips.MELBOURNE).strftime("%H:%M")
 
+def epoch_minutes_until(epoch, now_epoch):
+    """
+    Whole minutes between two epoch times as read off the HH:MM clock (10:59:59 -> 11:00:00 is 1 minute).
+    """
+    return epoch // 60 - now_epoch // 60
 
 """
  to be converted feature from terminal ver, might implement later
@@ -108,26 +120,25 @@ def format_time_display(time_str):
  render_next_stops()
 """
  
-def get_next_stops(conn, trip_id, current_seq):
+def get_next_stops(conn, trip_id, current_seq, since):
     '''
-    using the trip id, look for the remaining stops based on schedule data
+    using the trip id, look for the remaining stops based on schedule data, from `since` (seconds of the service day)
     '''
-    now_min = time_str_to_min(now)
 
-    q = f"""
+    q = """
     SELECT s.stop_name, st.arrival_time
     FROM stop_times st
     JOIN stops s ON st.stop_id = s.stop_id
-    WHERE st.trip_id = '{trip_id}'
-      AND st.stop_sequence + 0 > {current_seq}
+    WHERE st.trip_id = ?
+      AND st.stop_sequence > ?
+    ORDER BY st.stop_sequence
     """
-    cursor = conn.execute(q)
+    cursor = conn.execute(q, (trip_id, current_seq))
     # filter manually using minutes
     result = []
     for stop_name, arr_time in cursor.fetchall():
-        arr_min = time_str_to_min(arr_time)
-        if arr_min >= now_min:
-            result.append((stop_name, arr_time))
+        if arr_time // 60 >= since // 60:
+            result.append((stop_name, seconds_to_time_str(arr_time)))
     return result
 
 def render_next_stops(next_stops): 
@@ -174,6 +185,7 @@ def render_next_stops(next_stops):
 
     print()
 
+@metrics.timed("organise")
 def organise(station_name, trains, max_per_platform=3):
     """
     General Rules:
@@ -205,97 +217,205 @@ def organise(station_name, trains, max_per_platform=3):
 
     return limited
 
-def get_station_data(station_name, conn):
+# =====================
+# DEPARTURE BOARDS
+# =====================
+_boards = {"key": None, "days": {}, "successors": {}}   # days: {service_date: boards of that service day}
+_boards_lock = threading.Lock()
 
-    now = datetime.now().strftime("%H:%M:%S")
-    five_mins_ago = (datetime.now() - timedelta(minutes=3)).strftime("%H:%M:%S")
-    weekday = datetime.now().strftime("%A").lower()
-    today = datetime.now().strftime("%Y%m%d")
+def build_departure_boards(conn, service_date):
+    '''
+    Precompute the whole day's timetable once, grouped by station and platform:
+    {parent_stop_id: {platform_code: (sorted departure seconds, matching rows)}}
+    Trips terminating at the station (headsign is the station itself) are left out.
+    '''
+    weekday = service_date.strftime("%A").lower()
+    today = service_date.strftime("%Y%m%d")
 
     query = f"""
-    WITH ranked AS (
-        SELECT 
-            r.route_color,
-            s.platform_code,
-            t.trip_headsign,
-            st.departure_time,
-            t.trip_id,
-            st.stop_sequence,
-            t.block_id,
-            t.direction_id,
-            s.stop_name,
-
-        ROW_NUMBER() OVER (
-            PARTITION BY s.platform_code
-            ORDER BY st.departure_time
-        ) AS rn
-
-        FROM stop_times st
-        JOIN stops s ON st.stop_id = s.stop_id
-        JOIN trips t ON st.trip_id = t.trip_id
-        JOIN routes r ON t.route_id = r.route_id
-        JOIN calendar c ON t.service_id = c.service_id
-
-        WHERE s.parent_station = (
-            SELECT stop_id
-            FROM stops
-            WHERE stop_name LIKE '%{station_name}%'
-            AND location_type = '1'
-        )
-        AND s.stop_name LIKE '%{station_name}%'
-        AND LOWER(t.trip_headsign) NOT LIKE LOWER('%{station_name}%')
-        AND c.start_date <= '{today}'
-        AND c.end_date >= '{today}'
-        AND c.{weekday} = '1'
-        AND st.departure_time >= '{five_mins_ago}'
-    )
-
     SELECT
-        route_color,
-        platform_code,
-        trip_headsign,
-        departure_time,
-        trip_id,
-        block_id,
-        direction_id,
-        stop_name
-    FROM ranked
-    WHERE rn <= 12
-    ORDER BY CAST(platform_code AS INTEGER) ASC, departure_time;
-        """
-
-    cursor = conn.execute(query)
-    rows = cursor.fetchall()
-    station_name = rows[-1][-1] if rows else "No results found"
+        s.parent_station,
+        p.stop_name,
+        r.route_color,
+        s.platform_code,
+        t.trip_headsign,
+        st.departure_time,
+        t.trip_id,
+        t.block_id,
+        t.direction_id,
+        s.stop_name
+    FROM stop_times st
+    JOIN stops s ON st.stop_id = s.stop_id
+    JOIN stops p ON s.parent_station = p.stop_id
+    JOIN trips t ON st.trip_id = t.trip_id
+    JOIN routes r ON t.route_id = r.route_id
+    JOIN calendar c ON t.service_id = c.service_id
+    WHERE c.start_date <= ?
+      AND c.end_date >= ?
+      AND c.{weekday} = '1'
+      AND st.departure_time IS NOT NULL
+    ORDER BY st.departure_time
+    """
 
-    trip_lst = [each[4] for each in rows]                       # Get the list of trips to enquiry RT status
-    response = current_trips.enquiry(station_name, trip_lst)
+    stations = defaultdict(lambda: defaultdict(lambda: ([], [])))
+    for parent_id, parent_name, *row in conn.execute(query, (today, today)):
+        headsign = row[2] or ""
+        if parent_name.removesuffix(" Station").lower() in headsign.lower():
+            continue
+        departures, rows = stations[parent_id][row[1]]
+        departures.append(row[3])
+        rows.append(tuple(row))
+
+    return {parent_id: dict(platforms) for parent_id, platforms in stations.items()}
+
+def get_departure_boards(conn, service_date):
+    '''
+    Boards of every station for a service day (a timetable.Timetable with TIMETABLE_ENGINE = "array").
+    Built once per service day, only the two latest days are kept (yesterday runs past midnight),
+    and all are dropped when conn belongs to a newer gtfs.db (see db_pool).
+    '''
+    key = (getattr(conn, "generation", 0), TIMETABLE_ENGINE)
+    days = _boards["days"]
+    if _boards["key"] != key or service_date not in days:
+        with _boards_lock:
+            if _boards["key"] != key:
+                _boards.update(key=key, days={}, successors=load_block_successors(conn))
+            days = _boards["days"]
+            if service_date not in days:
+                with metrics.timer("boards_build"):
+                    if TIMETABLE_ENGINE == "array":
+                        boards = timetable.Timetable.load(conn, service_date)
+                    else:
+                        boards = build_departure_boards(conn, service_date)
+                days = {day: b for day, b in days.items() if abs((day - service_date).days) <= 1}
+                days[service_date] = boards
+                _boards["days"] = days
+    return days[service_date]
+
+def station_ids(conn, now):
+    '''
+    Parent stop_id of every station with departures on the service days running at epoch `now`.
+    '''
+    ids = {}
+    for service_date, day_start in current_trips.service_days(now):
+        boards = get_departure_boards(conn, service_date)
+        ids.update(dict.fromkeys(boards.station_ids() if isinstance(boards, timetable.Timetable) else boards))
+    return list(ids)
+
+def scheduled_departures(board, since, per_platform=MAX_PER_PLATFORM):
+    '''
+    Next per_platform departures of each platform from `since` (seconds), found by binary search.
+    '''
+    rows = []
+    for platform, (departures, platform_rows) in board.items():
+        i = bisect_left(departures, since)
+        rows.extend(platform_rows[i:i + per_platform])
+    return rows
+
+# =====================
+# STATION LOOKUP
+# =====================
+_stations = {}  # normalised station name -> parent stop_id
+db_pool.on_reload(reset_caches)
+
+def normalise_station_name(name):
+    '''
+    "  Flinders Street Station" -> "flinders street", so user input and GTFS names compare equal
+    '''
+    return " ".join(name.lower().split()).removesuffix(" station")
+
+def load_station_lookup(conn):
+    rows = conn.execute("SELECT stop_id, stop_name FROM stops WHERE location_type = '1'")
+    return {normalise_station_name(stop_name): stop_id for stop_id, stop_name in rows}
+
+def resolve_station(conn, station_name):
+    '''
+    Canonical parent stop_id for a user supplied station name.
+    Exact name first, otherwise the shortest station name containing it (partial ok), None if nothing matches.
+    '''
+    if not _stations:
+        _stations.update(load_station_lookup(conn))
+
+    key = normalise_station_name(station_name)
+    if key in _stations:
+        return _stations[key]
+    matches = [name for name in _stations if key and key in name]
+    return _stations[min(matches, key=len)] if matches else None
+
+def station_departures(conn, station_name, now):
+    '''
+    Resolve a user supplied station name and take its next scheduled departures at epoch `now`,
+    returns (station_id, rows) with rows sorted by platform then departure.
+    '''
+    station_id = resolve_station(conn, station_name)
+    return station_id, next_departures(conn, station_id, now)
+
+@metrics.timed("departures")
+def next_departures(conn, station_id, now):
+    '''
+    Next MAX_PER_PLATFORM departures of each platform from DEPARTED_WINDOW before epoch `now`, over every
+    service day still running (so trips timed past 24:00 show after midnight). Each board row gets its
+    departure as epoch seconds and the service_day_start it counts from appended:
+    (route_color, platform_code, headsign, departure, trip_id, block_id, direction_id, stop_name, service_day)
+    '''
+    if station_id is None:
+        return []
+
+    rows = []
+    for service_date, day_start in current_trips.service_days(now):
+        boards = get_departure_boards(conn, service_date)
+        since = now - DEPARTED_WINDOW - day_start
+        if isinstance(boards, timetable.Timetable):
+            day_rows = boards.departures(station_id, since, MAX_PER_PLATFORM)
+        else:
+            day_rows = scheduled_departures(boards.get(station_id, {}), since)
+        rows.extend((*row[:3], day_start + row[3], *row[4:], day_start) for row in day_rows)
+    rows.sort(key=lambda r: (int(r[1]) if str(r[1]).isdigit() else 0, r[3]))
+
+    taken = defaultdict(int)    # platform -> rows kept, as two service days can overlap
+    limited = []
+    for row in rows:
+        taken[row[1]] += 1
+        if taken[row[1]] <= MAX_PER_PLATFORM:
+            limited.append(row)
+    return limited
+
+def station_board_data(rows, response, now_epoch):
+    '''
+    Overlay the realtime response onto the scheduled rows of one station, in the format of /api/trains.
+    All times stay epoch seconds until they are formatted here.
+    '''
+    now = datetime.fromtimestamp(now_epoch, tz=current_trips.MELBOURNE).strftime("%H:%M:%S")
+    station_name = rows[-1][7] if rows else "No results found"
 
     trains = []
 
     for each in rows:
-        route_color, platform, headsign, dep_time, trip_id, block_id, direction_id, stop_name = each
+        route_color, platform, headsign, dep_time, trip_id, block_id, direction_id, stop_name, service_day = each
 
         # Showing dest for trip passing city's station if inbound trains heading to Flinders Street first
         if direction_id == "1" and any(word in station_name for word in CITY_STATIONS):
-            next_trip = find_next_trip_in_block(conn, block_id, trip_id)
+            next_trip = find_next_trip_in_block(trip_id)
             if next_trip:   headsign = f"{next_trip[0]}"
 
         # Default scheduled time calculations
-        mins = minutes_until(dep_time, now)
-        dep_time_display = format_time_display(dep_time)
+        mins = epoch_minutes_until(dep_time, now_epoch)
+        dep_time_display = format_epoch(dep_time)
 
         # Check with realtime response
         delay_int = 0
         trip_relationship = ""
+        stop_data = None
         if response and trip_id in response and response[trip_id]:
-            stop_data = response[trip_id][0]  # Only one stop matching station_name
-            trip_relationship = response[trip_id][0]["relationship"]
-            new_dep_time = format_time_display(stop_data["realtime"])
+            stop_data = response[trip_id][0]  # Only one stop matching the station
+            trip_relationship = stop_data["relationship"]
+
+        if stop_data and stop_data["realtime"] is not None:
+            new_dep_time = format_epoch(stop_data["realtime"])
             delay_int = stop_data["delay"]
 
             # Calculate mins until new departure
-            mins = minutes_until(new_dep_time, now)
+            mins = epoch_minutes_until(stop_data["realtime"], now_epoch)
             if dep_time_display == new_dep_time:    dep_time_display = f"{new_dep_time}"
             else:                                   dep_time_display = f"{dep_time_display} → {new_dep_time}"
 
@@ -320,8 +440,128 @@ def get_station_data(station_name, conn):
     trains.sort(key=lambda t: (int(t['platform']), t['minutes_until']))
 
     return {
-        "station": stop_name,
+        "station": station_name,
         "current_time": now,
         "trains": trains
     }
 
+def trip_service_days(rows):
+    '''
+    {trip_id: service_day_start} of board rows, so realtime is compared against the right service day.
+    '''
+    return {each[4]: each[8] for each in rows}
+
+def build_station_data(conn, station_id):
+    now = int(time.time())
+    rows = next_departures(conn, station_id, now)
+
+    trip_lst = [each[4] for each in rows]                       # Get the list of trips to enquiry RT status
+    response = current_trips.enquiry(station_id, trip_lst, trip_service_days(rows))
+
+    return station_board_data(rows, response, now)
+
+@metrics.timed("station_data")
+def get_station_data(station_name, conn):
+    '''
+    Board of one station, served from the response cache while board_cache_key() is unchanged.
+    The returned dict is shared with other callers, copy it before modifying.
+    '''
+    db_pool.check_version()
+    current_trips.get_feed_index()      # refresh a stale feed first, so the key carries its new version
+
+    key = board_cache_key(conn, station_name)
+    with _responses_lock:
+        data = _responses.get(key)
+        if data is not None:
+            _responses.move_to_end(key)
+            RESPONSE_CACHE_STATS["hits"] += 1
+            return data
+        RESPONSE_CACHE_STATS["misses"] += 1
+
+    data = build_station_data(conn, key[0])
+    with _responses_lock:
+        _responses[key] = data
+        while len(_responses) > RESPONSE_CACHE_SIZE:
+            _responses.popitem(last=False)
+    return data
+
+# =====================
+# RESPONSE CACHE
+# =====================
+_responses = OrderedDict()  # board_cache_key() -> get_station_data() result
+_responses_lock = threading.Lock()
+RESPONSE_CACHE_STATS = {"hits": 0, "misses": 0}
+metrics.register_counters("response_cache", lambda: dict(RESPONSE_CACHE_STATS))
+
+def board_cache_key(conn, station_name):
+    '''
+    (canonical station id, current minute, realtime feed version, gtfs.db generation),
+    a station's board only changes when one of them does.
+    '''
+    return (
+        resolve_station(conn, station_name),
+        int(time.time() // 60),
+        current_trips.feed_version(),
+        getattr(conn, "generation", 0),
+    )
+
+def board_etag(key):
+    return '"' + hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest() + '"'
+
+def response_cache_stats():
+    with _responses_lock:
+        return {**RESPONSE_CACHE_STATS, "size": len(_responses)}
+
+def get_stations_data(station_names, conn):
+    '''
+    Boards of several stations from one realtime snapshot and one scheduled-times query,
+    returned in the order asked, same format as get_station_data().
+    '''
+    db_pool.check_version()
+
+    now = int(time.time())
+    departures = [station_departures(conn, name, now) for name in station_names]
+
+    station_trips = {station_id: [each[4] for each in rows] for station_id, rows in departures if station_id}
+    day_starts = trip_service_days(row for station_id, rows in departures for row in rows)
+    responses = current_trips.enquiry_many(station_trips, day_starts)
+
+    return [station_board_data(rows, responses.get(station_id), now) for station_id, rows in departures]
+
+# =====================
+# NETWORK
+# =====================
+_network = (None, None)     # (key, get_network_data() result), replaced in one assignment so readers see a matching pair
+_network_lock = threading.Lock()
+
+def get_network_data(conn):
+    '''
+    Boards of every station with departures, from the in-memory departure boards, one realtime snapshot
+    and one scheduled-times query. Cached until the minute, the realtime feed or gtfs.db changes.
+    '''
+    global _network
+    db_pool.check_version()
+
+    now = int(time.time())
+    key = (now // 60, current_trips.feed_version(), getattr(conn, "generation", 0))
+    cached_key, data = _network
+    if cached_key == key:
+        return data
+
+    with _network_lock:
+        cached_key, data = _network
+        if cached_key != key:
+            departures = {station_id: next_departures(conn, station_id, now)
+                          for station_id in station_ids(conn, now)}
+            departures = {station_id: rows for station_id, rows in departures.items() if rows}
+            responses = current_trips.enquiry_many(
+                {station_id: [each[4] for each in rows] for station_id, rows in departures.items()},
+                trip_service_days(row for rows in departures.values() for row in rows),
+            )
+            stations = [station_board_data(rows, responses.get(station_id), now)
+                        for station_id, rows in departures.items()]
+            stations.sort(key=lambda board: board["station"])
+            data = {"current_time": datetime.fromtimestamp(now, tz=current_trips.MELBOURNE).strftime("%H:%M:%S"),
+                    "stations": stations}
+            _network = (key, data)
+    return data
@@ -0,0 +1,121 @@
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import math
+import threading
+import time
+
+# Metrics
+
+PREFIX = "nexttrain"
+WINDOW = 1024                   # latest samples per timer that quantiles are computed from
+QUANTILES = (0.5, 0.95, 0.99)
+
+_samples = defaultdict(lambda: deque(maxlen=WINDOW))    # (family, label, value) -> recent durations
+_totals = defaultdict(lambda: [0, 0.0])                 # (family, label, value) -> [count, sum] since start
+_counters = {}                                          # counter group -> function returning {name: value}
+_lock = threading.Lock()
+_request_timings = ContextVar("request_timings", default=None)
+
+def observe(family, label, value, seconds):
+    '''
+    Record one duration of the series family{label="value"}.
+    '''
+    key = (family, label, value)
+    with _lock:
+        _samples[key].append(seconds)
+        totals = _totals[key]
+        totals[0] += 1
+        totals[1] += seconds
+
+def observe_stage(stage, seconds):
+    observe("stage_seconds", "stage", stage, seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextmanager
+def timer(stage):
+    '''
+    Time the enclosed block as one sample of nexttrain_stage_seconds{stage=...}.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+def timed(stage):
+    '''
+    Decorator version of timer().
+    '''
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def register_counters(group, source):
+    '''
+    Export the dict returned by source() as nexttrain_<group>_<name>_total counters.
+    '''
+    _counters[group] = source
+
+def start_request():
+    '''
+    Collect the stage timings of the current request (context local, also seen by its worker threads),
+    returns the dict they are added to.
+    '''
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+def server_timing(timings):
+    '''
+    Server-Timing header value of the stages timed during a request, in milliseconds.
+    '''
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items())
+
+def quantile(samples, q):
+    '''
+    Nearest-rank quantile of sorted samples.
+    '''
+    return samples[max(math.ceil(q * len(samples)) - 1, 0)]
+
+def escape_label(value):
+    '''
+    Label value escaped as the text format requires (backslash, double quote, newline).
+    '''
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render():
+    '''
+    Every timer (as a summary with p50/p95/p99 over the last WINDOW samples) and counter
+    in the Prometheus text exposition format.
+    '''
+    with _lock:
+        series = {key: (sorted(samples), list(_totals[key])) for key, samples in _samples.items()}
+
+    lines = []
+    families = sorted({family for family, label, value in series})
+    for family in families:
+        name = f"{PREFIX}_{family}"
+        lines.append(f"# TYPE {name} summary")
+        for (series_family, label, value), (samples, (count, total)) in sorted(series.items()):
+            if series_family != family:
+                continue
+            value = escape_label(value)
+            for q in QUANTILES:
+                lines.append(f'{name}{{{label}="{value}",quantile="{q}"}} {quantile(samples, q):.6f}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {total:.6f}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {count}')
+
+    for group, source in sorted(_counters.items()):
+        for counter, value in source().items():
+            name = f"{PREFIX}_{group}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,59 +1,612 @@
 import csv
+from collections import defaultdict
 from datetime import datetime, timedelta
-from fastapi import FastAPI
+from itertools import islice
+from contextlib import asynccontextmanager, contextmanager, suppress
+from fastapi import FastAPI, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import sqlite3
 import current_trips
-from gtfs_query import get_station_data
+import db_pool
+import metrics
+import gtfs_query
+from gtfs_query import get_station_data, get_stations_data, get_network_data
 import os
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import zipfile
+import argparse
+import hashlib
+import hmac
 import webbrowser
 
 # Frontend
 
 GTFS_PATH = "gtfs_metro_trains/"
+GTFS_ZIP = "google_transit.zip"     # used by /api/rebuild instead of GTFS_PATH when present
 DB_FILE = "gtfs.db"
 
-app = FastAPI()
+WARM_UP = os.environ.get("WARM_UP", "1") != "0"   # WARM_UP=0 leaves everything to the first request (e.g. --reload)
+
+def timed_phase(phase, fn, *args):
+    """
+    Run one startup phase and print how long it took.
+    """
+    start = time.perf_counter()
+    result = fn(*args)
+    print(f"[startup] {phase:<16} {time.perf_counter() - start:>8.3f}s")
+    return result
+
+def warm_up():
+    """
+    Load what the first request needs, in the background once the server is up.
+    Nothing is read at import, every cache is also loaded lazily on first use.
+    """
+    timed_phase("api key", current_trips.get_api_key)
+    if db_outdated():
+        return      # no GTFS data to build it from, see prepare_db()
+
+    conn = timed_phase("database", db_pool.get_conn)
+    timed_phase("stop lookup", current_trips.get_station_stops)
+    timed_phase("station lookup", gtfs_query.resolve_station, conn, "")
+    timed_phase("departure boards", gtfs_query.station_ids, conn, int(time.time()))
+
+def prepare_db():
+    """
+    Build gtfs.db if it is missing or was built by an older version, before the server takes requests
+    (the board endpoints can't answer without it).
+    """
+    if not db_outdated():
+        return
+    if gtfs_source() is None:
+        print(f"[startup] {DB_FILE} missing or built by an older version, build it with --rebuild or POST /api/rebuild")
+        return
+    timed_phase("build database", init_db)
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Make sure gtfs.db is usable, then warm the caches up and run the realtime feed poller
+    for as long as the server is up.
+    """
+    await asyncio.to_thread(prepare_db)
+    if WARM_UP:
+        asyncio.create_task(asyncio.to_thread(timed_phase, "warm up", warm_up))
+    poller = asyncio.create_task(current_trips.poll_feed())
+    yield
+    poller.cancel()
+    with suppress(asyncio.CancelledError):
+        await poller
+    await current_trips.close_async_client()
+
+app = FastAPI(lifespan=lifespan)
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"   # add per-request stage timings as a Server-Timing header
+
+@app.middleware("http")
+async def request_metrics(request, call_next):
+    """
+    Time every API request (see /api/metrics), with SERVER_TIMING also report its stages to the client.
+    """
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    timings = metrics.start_request()
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")     # labelled by route template, so unknown paths can't add series
+    metrics.observe("request_seconds", "path", route.path if route else "other", time.perf_counter() - start)
+    if SERVER_TIMING and timings:
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
 app.mount("/frontend", StaticFiles(directory="frontend", html=True), name="frontend")
 
-def load_table(conn, table, filename):
+FILES = {
+    "stops": "stops.txt",
+    "stop_times": "stop_times.txt",
+    "trips": "trips.txt",
+    "routes": "routes.txt",
+    "calendar": "calendar.txt",
+}
+
+IMPORT_BATCH = 50000                # rows per executemany() call
+IMPORT_LOG = "import_log.jsonl"     # one timing report per import, to compare GTFS releases
+SCHEMA_VERSION = 1                  # PRAGMA user_version of gtfs.db, bumped when the stored layout changes
+                                    # (1: integer stop_times times and stop_sequence)
+
+# Columns stored as integers, everything else stays TEXT as in the GTFS files
+# (times are seconds since the start of the service day, so 25:02:00 -> 90120)
+COLUMN_TYPES = {
+    "stop_sequence": "INTEGER",
+    "arrival_time": "INTEGER",
+    "departure_time": "INTEGER",
+}
+
+INDEXES = {
+    "idx_stop_times_stop_departure": "stop_times(stop_id, departure_time)",
+    "idx_stop_times_trip_sequence": "stop_times(trip_id, stop_sequence)",
+    "idx_trips_trip": "trips(trip_id)",
+    "idx_trips_block": "trips(block_id)",
+    "idx_stops_stop": "stops(stop_id)",
+    "idx_stops_parent": "stops(parent_station)",
+    "idx_routes_route": "routes(route_id)",
+    "idx_calendar_service": "calendar(service_id)",
+}
+
+def parse_gtfs_time(time_str):
     """
-    Load a GTFS file into the SQLite database.
+    Convert a GTFS "HH:MM:SS" (hours may go past 24) into seconds since the start of the service day.
     """
-    with open(os.path.join(GTFS_PATH, filename), encoding="utf-8") as f:
+    if not time_str:
+        return None
+    h, m, s = map(int, time_str.split(":"))
+    return h * 3600 + m * 60 + s
+
+CONVERTERS = {
+    "stop_sequence": int,
+    "arrival_time": parse_gtfs_time,
+    "departure_time": parse_gtfs_time,
+}
+
+@contextmanager
+def open_gtfs_file(gtfs_path, filename):
+    """
+    Open a GTFS txt file, yields (headers, rows) with rows already converted to the column types used in gtfs.db.
+    """
+    with open(os.path.join(gtfs_path, filename), encoding="utf-8-sig", newline="") as f:
         reader = csv.reader(f)
-        headers = next(reader)
+        headers = [h.strip() for h in next(reader)]
+
+        converters = [(i, CONVERTERS[h]) for i, h in enumerate(headers) if h in CONVERTERS]
+        if converters:
+            def convert(row):
+                for i, func in converters:
+                    row[i] = func(row[i]) if row[i] else None
+                return row
+            reader = map(convert, reader)
+        yield headers, reader
+
+def load_table(conn, table, filename, gtfs_path=GTFS_PATH):
+    """
+    Load a GTFS file into the SQLite database, streamed in batches of IMPORT_BATCH rows.
+    Returns the number of rows loaded.
+    """
+    with open_gtfs_file(gtfs_path, filename) as (headers, reader):
         conn.execute(f"DROP TABLE IF EXISTS {table}")
-        conn.execute(f"CREATE TABLE {table} ({','.join(h + ' TEXT' for h in headers)})")
-        for row in reader:
-            conn.execute(f"INSERT INTO {table} VALUES ({','.join('?' * len(row))})", row)
-    conn.commit()
+        conn.execute(f"CREATE TABLE {table} ({','.join(h + ' ' + COLUMN_TYPES.get(h, 'TEXT') for h in headers)})")
+
+        insert = f"INSERT INTO {table} VALUES ({','.join('?' * len(headers))})"
+        rows = 0
+        while batch := list(islice(reader, IMPORT_BATCH)):
+            conn.executemany(insert, batch)
+            rows += len(batch)
+    return rows
+
+def create_indexes(conn):
+    """
+    Indexes used by gtfs_query / current_trips, plus planner statistics.
+    """
+    for name, target in INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+    conn.execute("ANALYZE")
+
+def build_derived_tables(conn):
+    """
+    Tables precomputed from the imported GTFS data, rebuilt after every import or update.
+    """
+    conn.execute("DROP TABLE IF EXISTS block_successors")
+    conn.execute(f"CREATE TABLE block_successors AS {gtfs_query.BLOCK_SUCCESSORS_QUERY}")
+    conn.execute("CREATE UNIQUE INDEX idx_block_successors_trip ON block_successors(trip_id)")
+
+def build_db(db_file=DB_FILE, gtfs_path=GTFS_PATH, source=None):
+    """
+    Import every GTFS file into db_file inside one transaction.
+    Journal and fsync are turned off while loading, so a failed import removes the half written file.
+    Returns the timing report {step: {"rows": n, "seconds": s}}.
+    """
+    report = {}
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -200000")     # ~200MB while building indexes
+        conn.execute("BEGIN")
+        for table, filename in FILES.items():
+            start = time.perf_counter()
+            rows = load_table(conn, table, filename, gtfs_path)
+            report[table] = {"rows": rows, "seconds": round(time.perf_counter() - start, 3)}
+
+        start = time.perf_counter()
+        create_indexes(conn)
+        report["indexes"] = {"rows": len(INDEXES), "seconds": round(time.perf_counter() - start, 3)}
+
+        start = time.perf_counter()
+        build_derived_tables(conn)
+        report["derived"] = {"rows": conn.execute("SELECT COUNT(*) FROM block_successors").fetchone()[0],
+                             "seconds": round(time.perf_counter() - start, 3)}
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.close()
+        os.remove(db_file)
+        raise
+    conn.close()
+
+    report["total"] = {"rows": sum(r["rows"] for t, r in report.items() if t in FILES),
+                       "seconds": round(sum(r["seconds"] for r in report.values()), 3)}
+    log_import_report(source or gtfs_path, report)
+    return report
+
+def log_import_report(source, report):
+    """
+    Print the import timings and append them to IMPORT_LOG.
+    """
+    for step, r in report.items():
+        print(f"[import] {step:<12} {r['rows']:>10,} rows  {r['seconds']:>8.2f}s")
+    with open(IMPORT_LOG, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"imported_at": datetime.now().isoformat(timespec="seconds"),
+                            "source": source, "report": report}) + "\n")
+
+def schema_version(db_file=DB_FILE):
+    """
+    SCHEMA_VERSION the database was built with, 0 for one built before it was recorded.
+    """
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+def db_outdated():
+    """
+    True when DB_FILE is missing or was built by an older version (e.g. times still stored as TEXT).
+    """
+    return not os.path.exists(DB_FILE) or schema_version() < SCHEMA_VERSION
+
+def gtfs_source():
+    """
+    GTFS_ZIP if present, otherwise GTFS_PATH, None when neither exists.
+    """
+    if os.path.exists(GTFS_ZIP):    return GTFS_ZIP
+    if os.path.isdir(GTFS_PATH):    return GTFS_PATH
+    return None
 
 def init_db():
     """
-    Initialize the database if it doesn't exist.
+    Build the database if it doesn't exist, rebuild it if an older version built it.
+    Returns False when it's needed but there is no GTFS data to build it from.
+    """
+    if not db_outdated():
+        return True
+    source = gtfs_source()
+    if source is None:
+        return False
+    if os.path.exists(DB_FILE):
+        print(f"[startup] {DB_FILE} was built by an older version, rebuilding from {source}")
+    rebuild_db(source)
+    return True
+
+# ----------------------------
+# Incremental update
+# ----------------------------
+# Key column of the small tables, diffed row by row
+TABLE_KEYS = {
+    "stops": "stop_id",
+    "routes": "route_id",
+    "calendar": "service_id",
+}
+
+def row_digest(row):
+    """
+    128-bit digest of one row as stored in gtfs.db.
+    """
+    return int.from_bytes(hashlib.blake2b(repr(tuple(row)).encode(), digest_size=16).digest(), "big")
+
+def combine_digests(total, row):
+    """
+    Order independent trip hash: sum of row digests, so file order and stop_sequence order agree.
+    """
+    return (total + row_digest(row)) & ((1 << 128) - 1)
+
+def table_columns(conn, table):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+
+def stored_trip_hashes(conn):
+    """
+    {trip_id: hash} of the trips currently in gtfs.db, computed once and kept in the trip_hashes table.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS trip_hashes (trip_id TEXT PRIMARY KEY, hash TEXT)")
+    hashes = dict(conn.execute("SELECT trip_id, hash FROM trip_hashes"))
+    if hashes:
+        return hashes
+
+    trip_col = table_columns(conn, "trips").index("trip_id")
+    stop_col = table_columns(conn, "stop_times").index("trip_id")
+    totals = defaultdict(int)
+    for row in conn.execute("SELECT * FROM trips"):
+        totals[row[trip_col]] = combine_digests(totals[row[trip_col]], row)
+    for row in conn.execute("SELECT * FROM stop_times"):
+        totals[row[stop_col]] = combine_digests(totals[row[stop_col]], row)
+
+    hashes = {trip_id: f"{total:032x}" for trip_id, total in totals.items()}
+    conn.executemany("INSERT INTO trip_hashes VALUES (?, ?)", hashes.items())
+    return hashes
+
+def update_keyed_table(conn, table, gtfs_path):
+    """
+    Apply the row differences of a small keyed table (stops/routes/calendar).
+    """
+    key = TABLE_KEYS[table]
+    with open_gtfs_file(gtfs_path, FILES[table]) as (headers, reader):
+        if headers != table_columns(conn, table):
+            raise ValueError(f"{FILES[table]} columns changed, run a full --rebuild")
+        key_col = headers.index(key)
+        new_rows = {row[key_col]: tuple(row) for row in reader}
+
+    old_rows = {row[key_col]: row for row in conn.execute(f"SELECT * FROM {table}")}
+    removed = old_rows.keys() - new_rows.keys()
+    added = new_rows.keys() - old_rows.keys()
+    modified = {k for k in new_rows.keys() & old_rows.keys() if new_rows[k] != old_rows[k]}
+
+    conn.executemany(f"DELETE FROM {table} WHERE {key} = ?", ((k,) for k in removed | modified))
+    conn.executemany(f"INSERT INTO {table} VALUES ({','.join('?' * len(headers))})",
+                     (new_rows[k] for k in added | modified))
+    return {"added": len(added), "removed": len(removed), "modified": len(modified)}
+
+def update_trips(conn, gtfs_path):
+    """
+    Hash every trip of the new release (trips.txt row + its stop_times rows) and only
+    delete/insert the trips whose hash differs from the one stored in gtfs.db.
+    """
+    old_hashes = stored_trip_hashes(conn)
+    totals = defaultdict(int)
+    with open_gtfs_file(gtfs_path, FILES["trips"]) as (trip_headers, reader):
+        if trip_headers != table_columns(conn, "trips"):
+            raise ValueError(f"{FILES['trips']} columns changed, run a full --rebuild")
+        trip_col = trip_headers.index("trip_id")
+        trip_rows = {}
+        for row in reader:
+            trip_rows[row[trip_col]] = row
+            totals[row[trip_col]] = combine_digests(totals[row[trip_col]], row)
+
+    with open_gtfs_file(gtfs_path, FILES["stop_times"]) as (stop_headers, reader):
+        if stop_headers != table_columns(conn, "stop_times"):
+            raise ValueError(f"{FILES['stop_times']} columns changed, run a full --rebuild")
+        stop_col = stop_headers.index("trip_id")
+        for row in reader:
+            totals[row[stop_col]] = combine_digests(totals[row[stop_col]], row)
+
+    new_hashes = {trip_id: f"{total:032x}" for trip_id, total in totals.items()}
+    removed = old_hashes.keys() - new_hashes.keys()
+    added = new_hashes.keys() - old_hashes.keys()
+    modified = {t for t in new_hashes.keys() & old_hashes.keys() if new_hashes[t] != old_hashes[t]}
+    changed = added | modified
+
+    for table in ("stop_times", "trips", "trip_hashes"):
+        conn.executemany(f"DELETE FROM {table} WHERE trip_id = ?", ((t,) for t in removed | modified))
+
+    # second pass only keeps the stop_times of changed trips
+    with open_gtfs_file(gtfs_path, FILES["stop_times"]) as (stop_headers, reader):
+        insert = f"INSERT INTO stop_times VALUES ({','.join('?' * len(stop_headers))})"
+        changed_rows = (row for row in reader if row[stop_col] in changed)
+        while batch := list(islice(changed_rows, IMPORT_BATCH)):
+            conn.executemany(insert, batch)
+    conn.executemany(f"INSERT INTO trips VALUES ({','.join('?' * len(trip_headers))})",
+                     (trip_rows[t] for t in changed if t in trip_rows))
+    conn.executemany("INSERT INTO trip_hashes VALUES (?, ?)", ((t, new_hashes[t]) for t in changed))
+
+    return {"added": len(added), "removed": len(removed), "modified": len(modified),
+            "unchanged": len(new_hashes) - len(changed)}
+
+def copy_db(db_file, dest):
+    """
+    Consistent copy of db_file through the SQLite backup API (readers are not blocked).
+    """
+    src = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    dst = sqlite3.connect(dest)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+def apply_update(db_file, gtfs_path):
+    """
+    Rewrite the changed rows of db_file in one transaction, returns {table: counts}.
+    """
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        report = {table: update_keyed_table(conn, table, gtfs_path) for table in TABLE_KEYS}
+        report["trips"] = update_trips(conn, gtfs_path)
+        build_derived_tables(conn)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return report
+
+def update_db(source=GTFS_PATH, db_file=DB_FILE):
+    """
+    Apply a new GTFS release, rewriting only what changed. The changes are made to a copy of db_file
+    which is validated and swapped in like rebuild_db() does, so readers never wait on a write lock
+    and keep seeing the old data until the swap. Returns {table: counts} plus the time taken.
+    """
+    if schema_version(db_file) < SCHEMA_VERSION:
+        print(f"[update] {db_file} was built by an older version, rebuilding it instead")
+        return rebuild_db(source)
+
+    start = time.perf_counter()
+    tmp_db = f"{db_file}.{os.getpid()}.new"
+
+    def build():
+        with tempfile.TemporaryDirectory() as extract_dir:
+            gtfs_path = extract_gtfs_zip(source, extract_dir) if zipfile.is_zipfile(source) else source
+            copy_db(db_file, tmp_db)
+            return apply_update(tmp_db, gtfs_path)
+
+    report = swap_in(tmp_db, build, db_file)
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    print(f"[update] trips +{report['trips']['added']} -{report['trips']['removed']} "
+          f"~{report['trips']['modified']} ({report['trips']['unchanged']:,} unchanged)  {report['seconds']:.2f}s")
+    with open(IMPORT_LOG, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"imported_at": datetime.now().isoformat(timespec="seconds"),
+                            "source": source, "mode": "incremental", "report": report}) + "\n")
+    return report
+
+# ----------------------------
+# Rebuild without downtime
+# ----------------------------
+REBUILD_STATUS = {"state": "idle", "source": None, "started_at": None, "finished_at": None, "error": None}
+_rebuild_lock = threading.Lock()
+
+def extract_gtfs_zip(zip_path, dest):
+    """
+    Extract a GTFS zip into dest and return the folder holding the txt files.
+    Accepts either google_transit.zip itself or the full Transport Victoria gtfs.zip (uses folder 2, Metro Trains).
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        names = zf.namelist()
+        if "stops.txt" in names:
+            zf.extractall(dest)
+            return dest
+        if "2/google_transit.zip" in names:
+            nested = zf.extract("2/google_transit.zip", dest)
+            return extract_gtfs_zip(nested, os.path.join(dest, "metro"))
+    raise ValueError(f"{zip_path} does not look like a GTFS Metro Trains zip")
+
+def validate_db(db_file):
+    """
+    Sanity check a freshly built database before it replaces the live one.
     """
-    if not os.path.exists(DB_FILE):
-        conn = sqlite3.connect(DB_FILE)
-        load_table(conn, "stops", "stops.txt")
-        load_table(conn, "stop_times", "stop_times.txt")
-        load_table(conn, "trips", "trips.txt")
-        load_table(conn, "routes", "routes.txt")
-        load_table(conn, "calendar", "calendar.txt")
+    conn = sqlite3.connect(db_file)
+    try:
+        if conn.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise ValueError(f"{db_file} failed the integrity check")
+        for table in FILES:
+            if not conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]:
+                raise ValueError(f"{db_file}: table {table} is empty")
+        if not conn.execute("SELECT COUNT(*) FROM stops WHERE location_type = '1'").fetchone()[0]:
+            raise ValueError(f"{db_file}: no parent stations found")
+    finally:
         conn.close()
 
+def swap_in(tmp_db, build, db_file=DB_FILE):
+    """
+    Run build() (which writes tmp_db), validate tmp_db and atomically replace db_file with it.
+    tmp_db is per process (a CLI --rebuild can run next to the server's) and removed on any failure.
+    Returns what build() returned.
+    """
+    try:
+        result = build()
+        validate_db(tmp_db)
+        os.replace(tmp_db, db_file)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_db)
+        raise
+    db_pool.check_version()
+    return result
+
+def rebuild_db(source=GTFS_PATH):
+    """
+    Import a GTFS folder or zip into a temporary database next to DB_FILE, validate it,
+    then atomically swap it in with os.replace(). Connections already open keep reading the
+    old file until they close, new ones see the new file, so /api/trains keeps serving throughout.
+    """
+    tmp_db = f"{DB_FILE}.{os.getpid()}.new"
+
+    def build():
+        with tempfile.TemporaryDirectory() as extract_dir:
+            gtfs_path = extract_gtfs_zip(source, extract_dir) if zipfile.is_zipfile(source) else source
+            return build_db(tmp_db, gtfs_path, source)
+
+    return swap_in(tmp_db, build)
+
+def _run_rebuild(source, incremental):
+    REBUILD_STATUS.update(state="running", source=source, error=None,
+                          started_at=datetime.now().isoformat(timespec="seconds"), finished_at=None)
+    try:
+        if incremental:     update_db(source)
+        else:               rebuild_db(source)
+        REBUILD_STATUS["state"] = "done"
+    except Exception as e:
+        REBUILD_STATUS.update(state="failed", error=str(e))
+    finally:
+        REBUILD_STATUS["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        _rebuild_lock.release()
+
+def start_rebuild(source=GTFS_PATH, incremental=False):
+    """
+    Run rebuild_db() (or update_db() when incremental) in a background thread,
+    returns False if one is already running.
+    """
+    if not _rebuild_lock.acquire(blocking=False):
+        return False
+    threading.Thread(target=_run_rebuild, args=(source, incremental), daemon=True).start()
+    return True
+
 # ----------------------------
 # API endpoint
 # ----------------------------
+def station_board(station):
+    return get_station_data(station, db_pool.get_conn())
+
+def station_board_if_changed(station, etag, realtime_age):
+    """
+    (ETag of the station's board, the board or None when it still matches the client's etag)
+    The ETag also covers realtime_age in whole minutes (as the dashboard shows it), so a 304
+    never leaves a client on an outdated age or stale state.
+    """
+    conn = db_pool.get_conn()
+    age_minutes = None if realtime_age is None else realtime_age // 60
+    current = gtfs_query.board_etag((gtfs_query.board_cache_key(conn, station), age_minutes))
+    if current == etag:
+        return current, None
+    return current, get_station_data(station, conn)
+
 @app.get("/api/trains")
-def trains(station: str):
+async def trains(station: str, request: Request):
     """
-    Get train data for a specific station.
+    Get train data for a specific station, 304 when the client's ETag is still current.
+    The realtime feed is awaited on the event loop, only the local database work runs in a worker thread.
     """
-    conn = sqlite3.connect(DB_FILE)
-    data = get_station_data(station, conn)
-    conn.close()
-    return data
+    await current_trips.get_feed_index_async()
+    realtime_age = current_trips.feed_age()
+    etag, data = await run_in_threadpool(station_board_if_changed, station, request.headers.get("If-None-Match"),
+                                         realtime_age)
+    if data is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse({**data, "realtime_age": realtime_age}, headers={"ETag": etag})
+
+def station_boards(stations):
+    return get_stations_data(stations, db_pool.get_conn())
+
+@app.get("/api/trains/batch")
+async def trains_batch(station: list[str] = Query()):
+    """
+    Get train data for several stations at once (?station=A&station=B...),
+    all boards share one realtime snapshot and one database pass.
+    """
+    await current_trips.get_feed_index_async()
+    boards = await run_in_threadpool(station_boards, station)
+    return {"stations": boards, "realtime_age": current_trips.feed_age()}
+
+def network_board():
+    return get_network_data(db_pool.get_conn())
+
+@app.get("/api/trains/network")
+async def trains_network():
+    """
+    Get the next departures of every station in one response, recomputed at most once per minute / feed update.
+    """
+    await current_trips.get_feed_index_async()
+    data = await run_in_threadpool(network_board)
+    return {**data, "realtime_age": current_trips.feed_age()}
 
 @app.get("/api/db-status")
 def db_status():
@@ -62,7 +615,58 @@ def db_status():
     """
     age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(DB_FILE))
     is_stale = age > timedelta(days=7)
-    return {"is_stale": is_stale}
+    return {"is_stale": is_stale, "rebuild": REBUILD_STATUS["state"]}
+
+REBUILD_TOKEN = os.environ.get("REBUILD_TOKEN")  # required as X-Rebuild-Token by POST /api/rebuild when set
+LOCAL_HOSTS = {"127.0.0.1", "::1"}              # callers allowed to POST /api/rebuild without REBUILD_TOKEN
+
+def rebuild_allowed(request):
+    """
+    With REBUILD_TOKEN set, callers must send it; otherwise only this machine may start a rebuild.
+    """
+    if REBUILD_TOKEN:
+        return hmac.compare_digest(request.headers.get("X-Rebuild-Token", ""), REBUILD_TOKEN)
+    return request.client is not None and request.client.host in LOCAL_HOSTS
+
+@app.post("/api/rebuild")
+def rebuild(request: Request, incremental: bool = False):
+    """
+    Rebuild gtfs.db in the background from GTFS_ZIP (if present) or GTFS_PATH, swapping it in when done.
+    With incremental=true only the changed trips/stops/routes/calendar rows are rewritten (on a copy, swapped in the same way).
+    403 unless rebuild_allowed(), only one rebuild runs at a time.
+    """
+    if not rebuild_allowed(request):
+        return JSONResponse({"detail": "rebuild not allowed from this client"}, status_code=403)
+    started = start_rebuild(gtfs_source() or GTFS_PATH, incremental)
+    return {"started": started, **REBUILD_STATUS}
+
+@app.get("/api/rebuild")
+def rebuild_status():
+    """
+    Progress of the last rebuild.
+    """
+    return REBUILD_STATUS
+
+@app.get("/api/feed-status")
+def feed_status():
+    """
+    Upstream traffic counters of the realtime feed (bytes, 304s, skipped parses).
+    """
+    return current_trips.feed_stats()
+
+@app.get("/api/cache-status")
+def cache_status():
+    """
+    Hits, misses and size of the station board response cache.
+    """
+    return gtfs_query.response_cache_stats()
+
+@app.get("/api/metrics")
+def metrics_endpoint():
+    """
+    Stage and request latencies (p50/p95/p99) and counters in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/api/key-check")
 def api_key_check():
@@ -72,6 +676,103 @@ def api_key_check():
     key, status = current_trips.load_api_key()
     return {"status": status}
 
+# ----------------------------
+# Server push
+# ----------------------------
+STREAM_CHECK_INTERVAL = 2   # seconds between checks for a new minute / realtime feed / database
+STREAM_KEEPALIVE = 15       # seconds between keep-alive comments on an idle stream
+
+_channels = {}  # station_id -> {"name", "subscribers": set of queues, "latest", "task"}
+
+def board_update(station):
+    """
+    Everything the dashboard shows for a station, including the db/key warnings.
+    """
+    data = dict(station_board(station))     # the board is shared through the response cache
+    data["is_stale"] = db_status()["is_stale"]
+    data["key_status"] = api_key_check()["status"]
+    data["realtime_age"] = current_trips.feed_age()
+    return data
+
+def publish(queue, data):
+    """
+    Subscribers only need the newest board, drop an unread one instead of queueing up.
+    """
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(data)
+
+async def run_channel(station_id):
+    """
+    Recompute a station's board only when the minute, realtime feed or database changes,
+    once for all subscribers. Stops when the last subscriber leaves.
+    A failed update (e.g. gtfs.db locked or being rebuilt) is logged and retried on the next check.
+    """
+    channel = _channels[station_id]
+    last_key = None
+    try:
+        while channel["subscribers"]:
+            try:
+                await current_trips.get_feed_index_async()      # refreshes the feed when stale
+                key = (datetime.now().strftime("%H:%M"), current_trips.feed_version(), db_pool.generation())
+                if key != last_key:
+                    channel["latest"] = await run_in_threadpool(board_update, channel["name"])
+                    last_key = key
+                    for queue in channel["subscribers"]:
+                        publish(queue, channel["latest"])
+            except Exception as e:
+                print(f"[stream] {channel['name']}: board update failed, retrying: {e!r}")
+            await asyncio.sleep(STREAM_CHECK_INTERVAL)
+    finally:
+        _channels.pop(station_id, None)
+
+async def subscribe(station_id, station):
+    queue = asyncio.Queue(maxsize=1)
+    channel = _channels.get(station_id)
+    if channel is None:
+        channel = _channels[station_id] = {"name": station, "subscribers": set(), "latest": None, "task": None}
+    channel["subscribers"].add(queue)
+    if channel["latest"] is not None:
+        publish(queue, channel["latest"])
+    if channel["task"] is None:
+        channel["task"] = asyncio.create_task(run_channel(station_id))
+    return channel, queue
+
+async def board_events(station_id, station):
+    channel, queue = await subscribe(station_id, station)
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE)
+                yield f"data: {json.dumps(data)}\n\n"
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+    finally:
+        channel["subscribers"].discard(queue)
+
+@app.get("/api/trains/stream")
+async def trains_stream(station: str):
+    """
+    Server-sent events: pushes the station's board (same shape as /api/trains plus is_stale/key_status)
+    whenever it changes, shared by every client watching the same station.
+    """
+    station_id = await run_in_threadpool(lambda: gtfs_query.resolve_station(db_pool.get_conn(), station))
+    return StreamingResponse(board_events(station_id, station), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == "__main__":
-    init_db()
-    webbrowser.open("http://127.0.0.1:8000/frontend/index.html", new=2)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Next Train dashboard")
+    parser.add_argument("--rebuild", nargs="?", const=GTFS_PATH, metavar="GTFS_DIR_OR_ZIP",
+                        help="rebuild gtfs.db from a GTFS folder or zip and swap it in (safe while the server runs)")
+    parser.add_argument("--update", nargs="?", const=GTFS_PATH, metavar="GTFS_DIR_OR_ZIP",
+                        help="apply a new GTFS release to gtfs.db, only rewriting the trips that changed")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild_db(args.rebuild)
+    elif args.update:
+        update_db(args.update)
+    else:
+        if not init_db():
+            print(f"{DB_FILE} missing or built by an older version and {GTFS_PATH} not found, see the readme")
+        webbrowser.open("http://127.0.0.1:8000/frontend/index.html", new=2)
\ No newline at end of file
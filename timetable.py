@@ -0,0 +1,149 @@
+from array import array
+from bisect import bisect_left
+
+# Timetable Engine
+
+class Timetable:
+    '''
+    One service day of departures held in flat int32 columns instead of one tuple per row.
+    Departures are sorted by (platform, departure seconds), so the next departures of a platform
+    are a binary search plus a slice. Strings (trip ids, headsigns, colours...) are interned in tables
+    and referenced by index.
+    Alternative to gtfs_query.build_departure_boards(), selected with gtfs_query.TIMETABLE_ENGINE = "array".
+    '''
+
+    def __init__(self):
+        self.strings = []                   # interned strings, every *_idx column points in here
+        self._string_idx = {}
+
+        # one entry per departure, sorted by (platform, departure)
+        self.departure = array("i")         # seconds of the service day
+        self.trip = array("i")              # index into the trip columns
+
+        # one entry per trip
+        self.trip_ids = array("i")
+        self.trip_headsign = array("i")
+        self.trip_color = array("i")
+        self.trip_block = array("i")
+        self.trip_direction = array("i")
+        self._trip_idx = {}
+
+        # one entry per platform (parent station, platform_code)
+        self.platform_start = array("i")    # first departure of the platform, the next platform's start ends it
+        self.platform_code = array("i")
+        self.platform_name = array("i")
+
+        self.stations = {}                  # parent stop_id -> list of platform indexes
+
+    def intern(self, value):
+        idx = self._string_idx.get(value)
+        if idx is None:
+            idx = self._string_idx[value] = len(self.strings)
+            self.strings.append(value)
+        return idx
+
+    def add_trip(self, trip_id, headsign, route_color, block_id, direction_id):
+        idx = self._trip_idx.get(trip_id)
+        if idx is None:
+            idx = self._trip_idx[trip_id] = len(self.trip_ids)
+            self.trip_ids.append(self.intern(trip_id))
+            self.trip_headsign.append(self.intern(headsign))
+            self.trip_color.append(self.intern(route_color))
+            self.trip_block.append(self.intern(block_id))
+            self.trip_direction.append(self.intern(direction_id))
+        return idx
+
+    @classmethod
+    def load(cls, conn, service_date):
+        '''
+        Build the timetable of service_date from gtfs.db, with the same rows as build_departure_boards():
+        trips terminating at the station (headsign is the station itself) are left out.
+        '''
+        weekday = service_date.strftime("%A").lower()
+        today = service_date.strftime("%Y%m%d")
+
+        query = f"""
+        SELECT
+            s.parent_station,
+            p.stop_name,
+            s.platform_code,
+            s.stop_name,
+            st.departure_time,
+            t.trip_id,
+            t.trip_headsign,
+            r.route_color,
+            t.block_id,
+            t.direction_id
+        FROM stop_times st
+        JOIN stops s ON st.stop_id = s.stop_id
+        JOIN stops p ON s.parent_station = p.stop_id
+        JOIN trips t ON st.trip_id = t.trip_id
+        JOIN routes r ON t.route_id = r.route_id
+        JOIN calendar c ON t.service_id = c.service_id
+        WHERE c.start_date <= ?
+          AND c.end_date >= ?
+          AND c.{weekday} = '1'
+          AND st.departure_time IS NOT NULL
+        ORDER BY s.parent_station, s.platform_code, st.departure_time
+        """
+
+        timetable = cls()
+        current = None
+        for parent_id, parent_name, platform_code, stop_name, departure, trip_id, headsign, color, block_id, direction_id \
+                in conn.execute(query, (today, today)):
+            if parent_name.removesuffix(" Station").lower() in (headsign or "").lower():
+                continue
+            if (parent_id, platform_code) != current:
+                current = (parent_id, platform_code)
+                timetable.stations.setdefault(parent_id, []).append(len(timetable.platform_start))
+                timetable.platform_start.append(len(timetable.departure))
+                timetable.platform_code.append(timetable.intern(platform_code))
+                timetable.platform_name.append(timetable.intern(stop_name))
+
+            timetable.departure.append(departure)
+            timetable.trip.append(timetable.add_trip(trip_id, headsign, color, block_id, direction_id))
+
+        timetable.platform_start.append(len(timetable.departure))
+        timetable._string_idx = None        # only needed while loading
+        timetable._trip_idx = None
+        return timetable
+
+    def station_ids(self):
+        return list(self.stations)
+
+    def row(self, i, platform):
+        '''
+        Departure i in the row format of build_departure_boards():
+        (route_color, platform_code, headsign, departure, trip_id, block_id, direction_id, stop_name)
+        '''
+        strings = self.strings
+        trip = self.trip[i]
+        return (
+            strings[self.trip_color[trip]],
+            strings[self.platform_code[platform]],
+            strings[self.trip_headsign[trip]],
+            self.departure[i],
+            strings[self.trip_ids[trip]],
+            strings[self.trip_block[trip]],
+            strings[self.trip_direction[trip]],
+            strings[self.platform_name[platform]],
+        )
+
+    def departures(self, parent_id, since, per_platform):
+        '''
+        Next per_platform departures of each platform of a station from `since` (seconds).
+        '''
+        rows = []
+        for platform in self.stations.get(parent_id, []):
+            start, end = self.platform_start[platform], self.platform_start[platform + 1]
+            i = bisect_left(self.departure, since, start, end)
+            rows.extend(self.row(j, platform) for j in range(i, min(i + per_platform, end)))
+        return rows
+
+    def nbytes(self):
+        '''
+        Bytes held by the int32 columns (the interned strings not included).
+        '''
+        columns = (self.departure, self.trip, self.trip_ids, self.trip_headsign, self.trip_color,
+                   self.trip_block, self.trip_direction, self.platform_start, self.platform_code, self.platform_name)
+        return sum(column.itemsize * len(column) for column in columns)